@@ -0,0 +1,99 @@
+"""Parse time of the *_coloc_gosud3 files: original startup loop vs coloc_cache parser.
+
+Run from DataViewer_Coloc_SMOS_TSG/:
+
+    python benchmarks/bench_parser.py [data_dir] [--repeat 3] [--workers 4]
+
+The cache is not involved, every variant parses all the files of data_dir. The legacy loop
+is timed with the compact schema applied to its frames, so every variant gives the same frames.
+"""
+import argparse
+import os
+import sys
+import time
+from io import StringIO
+
+import pandas as pd
+from pyproj import Transformer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coloc_cache import (COLUMNS, DATA_DIR, PARSE_WORKERS, compact_coloc_frame, list_coloc_files,  # noqa: E402
+                         parse_all, parse_coloc_file)
+
+
+def legacy_parse(filename):
+    """The loop flaskAppMultiThread.py ran on every file at startup"""
+    fichier = open(filename, "r")
+    save = fichier.read()
+    fichier.close()
+    dfColoc = pd.read_csv(StringIO(save), sep=r"\s+")
+    dfColoc.columns = COLUMNS
+    dfColoc['date'] = dfColoc['date_Argo'] + ' ' + dfColoc['heure_Argo']
+    dfColoc['date'] = pd.to_datetime(dfColoc['date'], format="%Y-%m-%d %H:%M:%S")
+    dfColoc['difference'] = dfColoc['SSS_TSG'] - dfColoc['SSS_Argo']
+    dfColoc = dfColoc[dfColoc['SSS_Argo'].notna()]
+    dfColoc = dfColoc[dfColoc['SSS_TSG'].notna()]
+    trans = Transformer.from_crs(
+        "epsg:4326",
+        "epsg:3857",
+        always_xy=True,
+    )
+    xx, yy = trans.transform(dfColoc["lon"], dfColoc["lat"])
+    dfColoc['mercatorX'] = xx
+    dfColoc['mercatorY'] = yy
+    return dfColoc
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def check_same(legacy, fast):
+    """The new parser must give the legacy frames once the compact schema is applied"""
+    for f in legacy:
+        pd.testing.assert_frame_equal(legacy[f], fast[f], check_exact=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the colocation file parsers')
+    parser.add_argument('data_dir', nargs='?', default=DATA_DIR)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS)
+    args = parser.parse_args()
+
+    files = list_coloc_files(args.data_dir)
+    size = sum(os.path.getsize(os.path.join(args.data_dir, f)) for f in files)
+    print('{} files, {:.1f} MB, best of {}'.format(len(files), size / 1e6, args.repeat))
+
+    variants = [
+        ('legacy loop + compact', lambda: {f: compact_coloc_frame(legacy_parse(os.path.join(args.data_dir, f)))
+                                           for f in files}),
+        ('parse_coloc_file loop', lambda: {f: parse_coloc_file(os.path.join(args.data_dir, f)) for f in files}),
+        ('parse_all, {} threads'.format(args.workers), lambda: parse_all(args.data_dir, files, args.workers)),
+    ]
+    results = {}
+    reference = None
+    for name, func in variants:
+        elapsed, results[name] = best_time(func, args.repeat)
+        reference = reference or elapsed
+        rows = sum(len(df) for df in results[name].values())
+        print('{:<28} {:8.3f} s  {:9d} rows  x{:.2f}'.format(name, elapsed, rows, reference / elapsed))
+
+    check_same(results['legacy loop + compact'], results['parse_coloc_file loop'])
+    print('outputs identical')
+    # memory held by the parsed frames, before and after the compact schema
+    legacy_bytes = sum(int(legacy_parse(os.path.join(args.data_dir, f)).memory_usage(deep=True).sum())
+                       for f in files)
+    fast_bytes = sum(int(df.memory_usage(deep=True).sum()) for df in results['parse_coloc_file loop'].values())
+    print('in memory: legacy {:.1f} MB, compact {:.1f} MB'.format(legacy_bytes / 1e6, fast_bytes / 1e6))
+
+
+if __name__ == '__main__':
+    main()
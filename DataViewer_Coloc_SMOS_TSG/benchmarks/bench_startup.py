@@ -0,0 +1,126 @@
+"""Time to first request of flaskAppMultiThread, in fresh interpreters.
+
+Run from DataViewer_Coloc_SMOS_TSG/:
+
+    python benchmarks/bench_startup.py [--repeat 5] [--importtime]
+    python benchmarks/bench_startup.py --rev <git revision> [--offline-models]
+
+Each run imports the app module in a new process (working directory: this
+directory, so data/ and cache/ are the usual ones), then serves GET / through the
+Flask test client. --rev measures the tree of another revision the same way, with
+the data/ and cache/ of this directory, for a before/after comparison.
+--offline-models registers the in-memory web.models of offline_models before the
+import, for the revisions importing the Django models at startup without the web project.
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(HERE)
+
+# run before the timed import
+OFFLINE_MODELS = '''
+import sys
+sys.path.insert(0, {!r})
+import offline_models
+offline_models.install()
+'''.format(HERE)
+
+RUN = '''
+import json, time
+start = time.perf_counter()
+import flaskAppMultiThread
+imported = time.perf_counter()
+app = getattr(flaskAppMultiThread, 'create_app', lambda: flaskAppMultiThread.app)()
+response = app.test_client().get('/')
+first = time.perf_counter()
+print(json.dumps({'import': imported - start, 'first_request': first - start, 'status': response.status_code}))
+'''
+
+
+def run_once(app_dir, importtime=False, offline_models=False):
+    script = (OFFLINE_MODELS if offline_models else '') + RUN
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', script]
+    result = subprocess.run(command, cwd=app_dir, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else 'failed')
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(stderr, count=15):
+    """Modules with the largest cumulative import time in a -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = [field.strip() for field in line[len('import time:'):].split('|')]
+        rows.append((int(cumulative), name))
+    return sorted(rows, reverse=True)[:count]
+
+
+def measure(app_dir, repeat, importtime, offline_models=False):
+    runs = [run_once(app_dir, offline_models=offline_models)[0] for _ in range(repeat)]
+    summary = {key: statistics.median(run[key] for run in runs) for key in ('import', 'first_request')}
+    summary['status'] = runs[-1]['status']
+    if importtime:
+        for cumulative, name in slowest_imports(run_once(app_dir, importtime=True, offline_models=offline_models)[1]):
+            print('    {:>10.3f} s  {}'.format(cumulative / 1e6, name.strip()))
+    return summary
+
+
+def checkout(rev):
+    """Worktree of rev whose app directory uses the data/ and cache/ of this one"""
+    worktree = tempfile.mkdtemp(prefix='coloc_startup_')
+    subprocess.run(['git', 'worktree', 'add', '--detach', worktree, rev], cwd=APP_DIR, check=True,
+                   capture_output=True)
+    app_dir = os.path.join(worktree, os.path.basename(APP_DIR))
+    for name in ('data', 'cache'):
+        if os.path.exists(os.path.join(APP_DIR, name)) and not os.path.exists(os.path.join(app_dir, name)):
+            os.symlink(os.path.join(APP_DIR, name), os.path.join(app_dir, name))
+    return worktree, app_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the time to first request of the Flask app')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--rev', help='also measure this git revision')
+    parser.add_argument('--importtime', action='store_true', help='list the slowest imports')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--offline-models', action='store_true',
+                        help='import the app with the in-memory web.models of offline_models')
+    args = parser.parse_args()
+
+    results = {}
+    targets = [('current', APP_DIR)]
+    worktree = None
+    if args.rev:
+        worktree, app_dir = checkout(args.rev)
+        targets.insert(0, (args.rev, app_dir))
+    try:
+        for name, app_dir in targets:
+            print('{}:'.format(name))
+            try:
+                results[name] = measure(app_dir, args.repeat, args.importtime, args.offline_models)
+            except RuntimeError as error:
+                print('    failed: {}'.format(error))
+                continue
+            print('    import {import:.3f} s, first request {first_request:.3f} s (HTTP {status}), '
+                  'median of {0}'.format(args.repeat, **results[name]))
+    finally:
+        if worktree is not None:
+            subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=APP_DIR, capture_output=True)
+            shutil.rmtree(worktree, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
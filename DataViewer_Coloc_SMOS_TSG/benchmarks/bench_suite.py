@@ -0,0 +1,267 @@
+"""Offline benchmarks of the colocation and viewer hot paths, on synthetic data.
+
+Run from DataViewer_Coloc_SMOS_TSG/:
+
+    python benchmarks/bench_suite.py --scale small --output results.json
+    python benchmarks/bench_suite.py --scale small --save-baseline
+    python benchmarks/bench_suite.py --scale small --baseline benchmarks/baseline_small.json
+
+Timings (seconds, best of --repeat):
+- colocation_*: ColocalizationProcess.process, in total and per stage (SMOS/transect loading,
+  TSG averaging, SMOS lookup, DB write through in-memory models)
+- ingest_cold / ingest_warm: loading every gosud3 file without, then with the columnar cache
+- viz_first / viz: construction of the Bokeh document of viz(), first and later sessions
+
+With a baseline, the timings slower than baseline * (1 + tolerance) are reported and the
+exit status is 1. benchmarks/baseline_small.json holds the median of 5 runs of the small
+scale, with the machine and package versions it was recorded on; a comparison run on
+another environment is warned about, its ratios mean little.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import numpy as np  # noqa: E402
+import pandas as pd  # noqa: E402
+
+import offline_models  # noqa: E402
+import synthetic  # noqa: E402
+
+SCALES = {
+    'small': {'days': 10, 'transects': 4, 'points': 2000, 'ships': 3, 'rows': 5000},
+    'medium': {'days': 60, 'transects': 20, 'points': 10000, 'ships': 10, 'rows': 50000},
+    'large': {'days': 180, 'transects': 100, 'points': 20000, 'ships': 65, 'rows': 200000},
+}
+TOLERANCE = 0.2
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class StageTimer(object):
+    """Accumulates the time spent in wrapped functions, per stage"""
+
+    def __init__(self):
+        self.totals = {}
+
+    def wrap(self, owner, name, stage):
+        func = getattr(owner, name)
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.totals[stage] = self.totals.get(stage, 0.0) + time.perf_counter() - start
+
+        setattr(owner, name, timed)
+        return func
+
+
+class NoProgress(object):
+
+    def set_progress(self, current, total):
+        pass
+
+
+def bench_colocation(workdir, params, repeat):
+    offline_models.install()
+    import comp_OSIT_filt
+
+    smos_dir = os.path.join(workdir, 'datasets')
+    transect_dir = os.path.join(workdir, 'transects')
+    os.makedirs(smos_dir, exist_ok=True)
+    os.makedirs(transect_dir, exist_ok=True)
+    synthetic.make_smos_cube(os.path.join(smos_dir, 'smos.mat'), params['days'])
+    transectTSG = synthetic.make_transects(params['transects'], params['points'], params['days'])
+    synthetic.write_transect_file(os.path.join(transect_dir, 'tsg.mat'), transectTSG)
+    if params.get('transect_store'):
+        from transect_store import convert_transects
+        convert_transects(os.path.join(transect_dir, 'tsg.mat'))
+
+    ColocalizationProcess = comp_OSIT_filt.ColocalizationProcess
+    ColocalizationProcess.transect_dir = os.path.join(transect_dir, '{}')
+    ColocalizationProcess.dataset_dir = os.path.join(smos_dir, '{}')
+    tsg_product = offline_models.TSGProduct(file='tsg.mat')
+    dataset = offline_models.Dataset(name='smos.mat')
+
+    # the stages are timed inside a normal serial run of process()
+    timer = StageTimer()
+    originals = [(comp_OSIT_filt, name, timer.wrap(comp_OSIT_filt, name, stage)) for name, stage in
+                 [('open_smos_dataset', 'colocation_load_smos'), ('mean_average_tsg', 'colocation_tsg_average'),
+                  ('nearest_day', 'colocation_smos_lookup'), ('smos_box_mean', 'colocation_smos_lookup')]]
+    originals.append((ColocalizationProcess, 'save_transects',
+                      timer.wrap(ColocalizationProcess, 'save_transects', 'colocation_db_write')))
+    try:
+        runs = []
+        for _ in range(repeat):
+            offline_models.reset(tsg_product, params['transects'])
+            timer.totals = {}
+            process = ColocalizationProcess(25, tsg_product, dataset, 'asc', list(range(params['transects'])),
+                                            None, None, 'bench', 0, NoProgress())
+            start = time.perf_counter()
+            process.process()
+            runs.append(dict(timer.totals, colocation_total=time.perf_counter() - start))
+    finally:
+        for owner, name, func in originals:
+            setattr(owner, name, func)
+    best = min(runs, key=lambda run: run['colocation_total'])
+    return best
+
+
+def bench_ingest(workdir, params, repeat):
+    from coloc_cache import load_all
+
+    data_dir = os.path.join(workdir, 'data')
+    cache_dir = os.path.join(workdir, 'cache')
+    synthetic.make_gosud3_files(data_dir, params['ships'], params['rows'])
+
+    def cold():
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        load_all(data_dir, cache_dir)
+
+    timings = {'ingest_cold': best_time(cold, repeat)}
+    timings['ingest_warm'] = best_time(lambda: load_all(data_dir, cache_dir), repeat)
+    return timings
+
+
+def bench_viz(workdir, repeat):
+    """viz() of the app, on the gosud3 files of bench_ingest (the app reads data/ of its working directory)"""
+    from bokeh.document import Document
+
+    offline_models.install()
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        try:
+            import flaskAppMultiThread
+        except Exception as error:
+            print('viz skipped, the app module cannot be imported here: {!r}'.format(error))
+            return {}
+        start = time.perf_counter()
+        flaskAppMultiThread.viz(Document())
+        timings = {'viz_first': time.perf_counter() - start}
+        timings['viz'] = best_time(lambda: flaskAppMultiThread.viz(Document()), repeat)
+        return timings
+    finally:
+        os.chdir(cwd)
+
+
+# packages whose version is recorded with the results
+PACKAGES = ['numpy', 'pandas', 'scipy', 'pyproj', 'bokeh', 'holoviews', 'h5py', 'xarray']
+
+
+def environment():
+    """Machine and package versions the timings were measured with"""
+    from importlib.metadata import PackageNotFoundError, version
+
+    env = {'python': platform.python_version(), 'platform': platform.platform(),
+           'machine': platform.machine(), 'cpus': os.cpu_count()}
+    for package in PACKAGES:
+        try:
+            env[package] = version(package)
+        except PackageNotFoundError:
+            env[package] = None
+    return env
+
+
+def compare(timings, baseline, tolerance):
+    """Print the ratio to the baseline of every timing, returns the names of the regressions"""
+    regressions = []
+    for name, elapsed in sorted(timings.items()):
+        reference = baseline['timings'].get(name)
+        if reference is None:
+            print('{:<28} {:9.4f} s  (no baseline)'.format(name, elapsed))
+            continue
+        ratio = elapsed / reference if reference else float('inf')
+        flag = ''
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('{:<28} {:9.4f} s  baseline {:9.4f} s  x{:.2f}{}'.format(name, elapsed, reference, ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the colocation and viewer hot paths on synthetic data')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    for key in SCALES['small']:
+        parser.add_argument('--' + key, type=int, help='override the {} of the scale'.format(key))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--only', nargs='+', choices=['colocation', 'ingest', 'viz'],
+                        default=['colocation', 'ingest', 'viz'])
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare with the results of this JSON file')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to benchmarks/baseline_<scale>.json')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--workdir', help='keep the synthetic data in this directory')
+    parser.add_argument('--transect-store', action='store_true',
+                        help='colocate from the indexed transect store instead of the .mat file')
+    args = parser.parse_args()
+
+    params = dict(SCALES[args.scale])
+    params.update({key: getattr(args, key) for key in params if getattr(args, key) is not None})
+    params['transect_store'] = args.transect_store
+    workdir = args.workdir or tempfile.mkdtemp(prefix='coloc_bench_')
+    print('scale {}: {}, data in {}'.format(args.scale, params, workdir))
+
+    timings = {}
+    try:
+        if 'colocation' in args.only:
+            timings.update(bench_colocation(workdir, params, args.repeat))
+        if 'ingest' in args.only or 'viz' in args.only:
+            timings.update(bench_ingest(workdir, params, args.repeat))
+        if 'viz' in args.only:
+            timings.update(bench_viz(workdir, args.repeat))
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    results = {'scale': args.scale, 'params': params, 'repeat': args.repeat,
+               'environment': environment(), 'timings': timings}
+    outputs = [args.output] if args.output else []
+    if args.save_baseline:
+        outputs.append(os.path.join(HERE, 'baseline_{}.json'.format(args.scale)))
+    for output in outputs:
+        with open(output, 'w') as outfile:
+            json.dump(results, outfile, indent=2)
+        print('results written to {}'.format(output))
+
+    if args.baseline:
+        with open(args.baseline) as infile:
+            baseline = json.load(infile)
+        if baseline.get('params') != params:
+            print('warning: baseline parameters {} differ from {}'.format(baseline.get('params'), params))
+        current = environment()
+        changed = {key: (value, current.get(key)) for key, value in baseline.get('environment', {}).items()
+                   if current.get(key) != value}
+        if changed:
+            # the timings only compare on the machine and versions the baseline was recorded with
+            print('warning: baseline recorded on another environment: {}'.format(
+                ', '.join('{} {} -> {}'.format(key, *values) for key, values in sorted(changed.items()))))
+        regressions = compare(timings, baseline, args.tolerance)
+        if regressions:
+            print('{} regressions above {:.0%}: {}'.format(len(regressions), args.tolerance, ', '.join(regressions)))
+            sys.exit(1)
+    else:
+        compare(timings, {'timings': {}}, args.tolerance)
+
+
+if __name__ == '__main__':
+    main()
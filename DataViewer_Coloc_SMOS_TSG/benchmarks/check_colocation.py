@@ -0,0 +1,265 @@
+"""Colocation stages vs the per-measure loops of the original ColocalizationProcess.process.
+
+Run from DataViewer_Coloc_SMOS_TSG/:
+
+    python benchmarks/check_colocation.py [--transects 20] [--points 3000] [--days 8] [--seed 0]
+
+On synthetic transects (NaN padded, single point, empty, unsorted dates, dates on the edges
+of the averaging windows; at least 5 transects), for meanr_ave
+25, 50 and 75, the outputs must be identical (NaN at the same places) to the legacy ones:
+- mean_average_tsg: the loop over the measures of a transect
+- nearest_day and smos_box_mean: the KDTree query and box mean of every averaged measure
+- datenum_to_datetime64 and datevec: matlab_date_to_datetime of every datenum
+"""
+import argparse
+import os
+import sys
+import time
+import warnings
+from datetime import datetime, timedelta
+from math import floor
+
+import numpy as np
+import pandas as pd
+from scipy import logical_and, spatial
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import offline_models  # noqa: E402
+import synthetic  # noqa: E402
+
+# (dnearc, tmeanc, dmeanc) of ColocalizationProcess for each meanr_ave
+AVERAGES = {25: (0.125, 0.125, 0.25), 50: (0.125, 0.125, 0.5), 75: (0.75, 0.5, 0.75)}
+
+
+def legacy_matlab_date_to_datetime(datev):
+    return pd.NaT if np.isnan(datev) \
+        else datetime.fromordinal(int(datev)) + timedelta(days=datev % 1) - timedelta(days=366)
+
+
+def legacy_datevec(d):
+    def datetime2vector(d):
+        return [d.year, d.month, d.day, d.hour, d.minute, d.second]
+
+    if isinstance(d, float):
+        d = np.array([d])
+    return np.array([datetime2vector(legacy_matlab_date_to_datetime(x)) for x in d])
+
+
+def legacy_mean_average(unTSG, dnearc, dmeanc, tmeanc, great_circle):
+    """The measure loop of the original process(), un2TSG of one transect"""
+    un2TSG = np.empty((unTSG.shape[0], 6))
+    un2TSG[:] = np.nan
+    isupmesure = -1
+    latc_used = 0
+    lonc_used = 0
+    for imesure in range(unTSG.shape[0]):
+        latc = ((round((unTSG[imesure, 1] + 90) * 4)) / 4 - 90) - dnearc
+        lonc = ((round((unTSG[imesure, 2] + 180) * 4)) / 4 - 180) - dnearc
+        if latc_used != latc and lonc_used != lonc:
+            replatc = np.tile(latc, (unTSG.shape[0], 1))
+            replonc = np.tile(lonc, (unTSG.shape[0], 1))
+            repdate = np.tile(unTSG[imesure, 0], (unTSG.shape[0], 1))
+            if not unTSG[:, 1].shape == (1, ):
+                dist_center = great_circle(np.squeeze(np.dstack((unTSG[:, 1], unTSG[:, 2]))),
+                                           np.squeeze(np.dstack((replatc, replonc))))
+                time_center = np.abs(repdate - unTSG[:, 0][..., np.newaxis])
+                round_sal = np.nonzero(logical_and(dist_center < dmeanc, time_center < tmeanc))[0]
+                isupmesure += 1
+                un2TSG[isupmesure, 0] = unTSG[imesure, 0]
+                un2TSG[isupmesure, 1] = unTSG[imesure, 1]
+                un2TSG[isupmesure, 2] = unTSG[imesure, 2]
+                un2TSG[isupmesure, 3] = np.mean(unTSG[round_sal, 3])
+                un2TSG[isupmesure, 4] = np.mean(unTSG[round_sal, 4])
+                un2TSG[isupmesure, 5] = np.nanstd(unTSG[round_sal, 3])
+                latc_used = latc
+                lonc_used = lonc
+            else:
+                isupmesure += 1
+                un2TSG[isupmesure, :] = np.nan
+    return un2TSG
+
+
+def legacy_smos_lookup(unTSG, dateSSS3, SSS_smos3, ngrid_coloc):
+    """The SMOS loop of the original process(): (nearest day, box mean) of every averaged measure"""
+    d3_long = SSS_smos3.shape[-1]
+    nbdays = np.empty(unTSG.shape[0], dtype=int)
+    sal3 = np.empty(unTSG.shape[0])
+    sal3[:] = np.nan
+    for imesure in range(unTSG.shape[0]):
+        if unTSG[imesure, 1] == -90:
+            ilati = 720
+        else:
+            ilati = floor((unTSG[imesure, 1] + 90) / 0.25)
+        if unTSG[imesure, 2] == -180:
+            ilong = 1440
+        else:
+            ilong = floor((unTSG[imesure, 2] + 180) / 0.25)
+
+        if unTSG[imesure, 0] > dateSSS3[-1] + 2:
+            nbdaySSS3 = d3_long + 1
+        elif unTSG[imesure, 0] < dateSSS3[0] - 2:
+            nbdaySSS3 = 0
+        else:
+            nbdaySSS3 = spatial.KDTree(dateSSS3[:, np.newaxis]).query([unTSG[imesure, 0]])[1]
+        nbdays[imesure] = nbdaySSS3
+
+        indicelgbeg = ilong - ngrid_coloc
+        indicelgend = ilong + ngrid_coloc
+        rangelon = np.mod(
+            np.array([[indicelgbeg]]) if indicelgbeg == indicelgend
+            else np.arange(indicelgbeg, indicelgend)[:, np.newaxis], 1440)
+        rangelon[np.nonzero(rangelon == 0)[0]] = 1440
+
+        indiceltbeg = ilati - ngrid_coloc
+        indiceltend = ilati + ngrid_coloc
+        rangelat = np.mod(
+            np.array([[indiceltbeg]]) if indiceltbeg == indiceltend
+            else np.arange(indiceltbeg, indiceltend)[:, np.newaxis], 720)
+        rangelat[np.nonzero(rangelat == 0)[0]] = 720
+
+        if nbdaySSS3 > 0 and nbdaySSS3 <= d3_long:
+            SSSz3 = SSS_smos3[rangelon - 1, rangelat - 1, nbdaySSS3]
+            sal3[imesure] = np.mean(SSSz3[~np.isnan(SSSz3)])
+    return nbdays, sal3
+
+
+def valid_measures(transect):
+    """Leading measures of a NaN padded transect, as many as it has valid dates"""
+    return transect[:np.sum(~np.isnan(transect[:, 0]))]
+
+
+def make_cases(ntransects, npoints, ndays, seed=0):
+    """Valid measures of synthetic transects, plus the edge cases"""
+    transectTSG = synthetic.make_transects(ntransects, npoints, ndays, seed)
+    cases = [valid_measures(transect) for transect in transectTSG]
+    rng = np.random.default_rng(seed)
+    # single measure, no measure, unsorted dates, a ship at anchor (every measure in the same cell)
+    cases.append(cases[0][:1])
+    cases.append(cases[0][:0])
+    cases.append(cases[1][rng.permutation(len(cases[1]))])
+    anchored = cases[2][:500].copy()
+    anchored[:, 1:3] = anchored[0, 1:3]
+    cases.append(anchored)
+    # dates off the minute grid, and dates on the edges of the time windows (multiples of 1/64 day, +/- 1e-12)
+    jittered = cases[3].copy()
+    jittered[:, 0] += rng.uniform(0, synthetic.TSG_STEP, len(jittered))
+    cases.append(jittered)
+    edges = cases[4][:400].copy()
+    edges[:, 0] = edges[0, 0] + np.arange(len(edges)) / 64 + rng.choice([-1e-12, 0, 1e-12], len(edges))
+    cases.append(edges)
+    return cases
+
+
+def make_smos(ndays, seed=0):
+    """(dateSSS3, SSS_smos3 (lon, lat, day) with NaN for no data) as process() reads them"""
+    rng = np.random.default_rng(seed)
+    SSS_smos3 = np.stack([synthetic.smos_field(rng, day).T for day in range(ndays)], axis=-1).astype(np.float64)
+    SSS_smos3[SSS_smos3 == 0] = np.nan
+    return synthetic.START_DATENUM + np.arange(ndays, dtype=np.float64), SSS_smos3
+
+
+def check_same(name, expected, actual):
+    np.testing.assert_array_equal(actual, expected, err_msg=name, strict=True)
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return time.perf_counter() - start, result
+
+
+def check_mean_average(comp_OSIT_filt, cases):
+    averaged = {}
+    for meanr_ave, (dnearc, tmeanc, dmeanc) in sorted(AVERAGES.items()):
+        legacy_time, expected = timed(lambda: [legacy_mean_average(unTSG, dnearc, dmeanc, tmeanc,
+                                                                   comp_OSIT_filt.great_circle) for unTSG in cases])
+        new_time, actual = timed(lambda: [comp_OSIT_filt.mean_average_tsg(unTSG, dnearc, dmeanc, tmeanc)
+                                          for unTSG in cases])
+        for i, (un2TSG_expected, un2TSG) in enumerate(zip(expected, actual)):
+            check_same('mean_average_tsg, meanr_ave {}, case {}'.format(meanr_ave, i), un2TSG_expected, un2TSG)
+        print('mean_average_tsg  meanr_ave {}: legacy {:8.3f} s, new {:8.3f} s, identical'.format(
+            meanr_ave, legacy_time, new_time))
+        averaged[meanr_ave] = [valid_measures(un2TSG) for un2TSG in actual]
+    return averaged
+
+
+def check_smos_lookup(comp_OSIT_filt, averaged, dateSSS3, SSS_smos3):
+    for meanr_ave, cases in sorted(averaged.items()):
+        cases = [unTSG for unTSG in cases if unTSG.shape[0] > 1]  # colocate_transect stops before the lookup
+        for ngrid_coloc in (0, 2):
+            legacy_time, expected = timed(lambda: [legacy_smos_lookup(unTSG, dateSSS3, SSS_smos3, ngrid_coloc)
+                                                   for unTSG in cases])
+
+            def lookup(unTSG):
+                nbday = comp_OSIT_filt.nearest_day(dateSSS3, unTSG[:, 0])
+                return nbday, comp_OSIT_filt.smos_box_mean(SSS_smos3, unTSG[:, 1], unTSG[:, 2], nbday, ngrid_coloc)
+
+            new_time, actual = timed(lambda: [lookup(unTSG) for unTSG in cases])
+            for i, ((nbday_expected, sal_expected), (nbday, sal)) in enumerate(zip(expected, actual)):
+                label = 'meanr_ave {}, ngrid_coloc {}, case {}'.format(meanr_ave, ngrid_coloc, i)
+                check_same('nearest_day, ' + label, nbday_expected, nbday.astype(int))
+                check_same('smos_box_mean, ' + label, sal_expected, sal)
+            print('smos lookup       meanr_ave {}, ngrid_coloc {}: legacy {:8.3f} s, new {:8.3f} s, identical'.format(
+                meanr_ave, ngrid_coloc, legacy_time, new_time))
+
+    # day ties, the bounds of the SMOS period and a one-day cube
+    dates = np.concatenate([dateSSS3[:-1] + 0.5, dateSSS3[[0, -1]] + [-2, 2], dateSSS3[[0, -1]] + [-2.001, 2.001],
+                            dateSSS3 + 1e-9, dateSSS3 - 1e-9])
+    for days in (dateSSS3, dateSSS3[:1]):
+        unTSG = np.column_stack([dates, np.zeros((len(dates), 4))])
+        expected, _ = legacy_smos_lookup(unTSG, days, SSS_smos3[:, :, :len(days)], 0)
+        check_same('nearest_day, {} days, ties and bounds'.format(len(days)), expected,
+                   comp_OSIT_filt.nearest_day(days, dates).astype(int))
+    print('nearest_day       ties and period bounds: identical')
+
+
+def check_dates(comp_OSIT_filt, cases):
+    rng = np.random.default_rng(1)
+    datenums = np.concatenate([unTSG[:, 0] for unTSG in cases] +
+                              [synthetic.START_DATENUM + rng.uniform(-5000, 5000, 100000),
+                               # whole days, half microseconds and NaN
+                               synthetic.START_DATENUM + np.arange(-10, 10, dtype=np.float64),
+                               synthetic.START_DATENUM + (np.arange(1000) + 0.5) / 86400e6,
+                               [np.nan]])
+    legacy_time, expected = timed(lambda: [legacy_matlab_date_to_datetime(d) for d in datenums.tolist()])
+    new_time, actual = timed(lambda: comp_OSIT_filt.datenum_to_datetime64(datenums).tolist())
+    for datenum, date_expected, date in zip(datenums.tolist(), expected, actual):
+        if date_expected is pd.NaT:
+            assert date is None, 'datenum_to_datetime64({!r}) = {!r}, not NaT'.format(datenum, date)
+        else:
+            assert date == date_expected, 'datenum_to_datetime64({!r}) = {!r}, not {!r}'.format(
+                datenum, date, date_expected)
+    print('datenum_to_datetime64 ({} dates): legacy {:8.3f} s, new {:8.3f} s, identical'.format(
+        len(datenums), legacy_time, new_time))
+
+    check_same('datevec', legacy_datevec(datenums[:-1]), comp_OSIT_filt.datevec(datenums[:-1]))
+    check_same('datevec with NaN', legacy_datevec(datenums[-2:]).astype(np.float64),
+               comp_OSIT_filt.datevec(datenums[-2:]))
+    print('datevec: identical')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the colocation stages against the original loops')
+    parser.add_argument('--transects', type=int, default=20)
+    parser.add_argument('--points', type=int, default=3000)
+    parser.add_argument('--days', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    offline_models.install()
+    import comp_OSIT_filt
+
+    # the legacy loops average empty boxes and windows
+    warnings.simplefilter('ignore', category=RuntimeWarning)
+    cases = make_cases(args.transects, args.points, args.days, args.seed)
+    print('{} transects, {} measures'.format(len(cases), sum(len(unTSG) for unTSG in cases)))
+    averaged = check_mean_average(comp_OSIT_filt, cases)
+    check_smos_lookup(comp_OSIT_filt, averaged, *make_smos(args.days, args.seed))
+    check_dates(comp_OSIT_filt, cases)
+    print('outputs identical')
+
+
+if __name__ == '__main__':
+    main()
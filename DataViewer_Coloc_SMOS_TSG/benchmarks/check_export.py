@@ -0,0 +1,117 @@
+"""Exported records vs the cleaned frames of coloc_cache.
+
+Run from DataViewer_Coloc_SMOS_TSG/:
+
+    python benchmarks/check_export.py [data_dir] [--ships 3] [--batch-rows 1000]
+
+The first ships of data_dir are exported as an Arrow IPC stream and as Parquet, once with a
+cold cache (parsed entries) and once with the cache built (memory-mapped entries), for every
+date and for two periods. Read back with pyarrow, the records must be the ones of
+load_coloc_file, in date order, with the export schema.
+"""
+import argparse
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from coloc_cache import CATEGORY_COLUMNS, DATA_DIR, INT_COLUMNS, list_coloc_files, load_coloc_file  # noqa: E402
+from export import EXPORT_COLUMNS, export_schema, parse_periods, stream_export  # noqa: E402
+
+
+def expected_records(path, cache_dir, ships, periods):
+    """Records of the ships within the periods, built from the cleaned frames"""
+    frames = []
+    for name in ships:
+        dfColoc = load_coloc_file(os.path.join(path, name), cache_dir)
+        dfColoc = dfColoc.sort_values('date', kind='stable')
+        dates = dfColoc['date'].to_numpy()
+        keep = np.zeros(len(dfColoc), dtype=bool)
+        for start, end in periods:
+            keep |= (True if start is None else dates >= start) & (True if end is None else dates <= end)
+        dfColoc = dfColoc[keep].copy()
+        dfColoc.insert(0, 'ship', name)
+        frames.append(dfColoc[EXPORT_COLUMNS])
+    return pd.concat(frames, ignore_index=True)
+
+
+def read_export(data, fmt):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if fmt == 'parquet':
+        return pq.read_table(io.BytesIO(data))
+    return pa.ipc.open_stream(data).read_all()
+
+
+def value_types(schema):
+    """[(name, type)] of a schema, the value type for the dictionary columns"""
+    return [(field.name, getattr(field.type, 'value_type', field.type)) for field in schema]
+
+
+def check_same(name, expected, table, fmt):
+    # Parquet does not keep the width of the dictionary indices
+    if (table.schema != export_schema() if fmt == 'arrow' else
+            value_types(table.schema) != value_types(export_schema())):
+        raise AssertionError('{}: schema {} is not the export schema'.format(name, table.schema))
+    actual = table.to_pandas()
+    if len(actual) != len(expected):
+        raise AssertionError('{}: {} rows exported, {} expected'.format(name, len(actual), len(expected)))
+    for col in EXPORT_COLUMNS:
+        if col in CATEGORY_COLUMNS or col == 'ship':
+            np.testing.assert_array_equal(actual[col].astype(object).to_numpy(),
+                                          expected[col].astype(object).to_numpy(), err_msg=col)
+        elif col == 'date':
+            np.testing.assert_array_equal(actual[col].to_numpy(), expected[col].to_numpy(), err_msg=col)
+        elif col in INT_COLUMNS:
+            np.testing.assert_array_equal(actual[col].to_numpy(dtype=np.float64, na_value=np.nan),
+                                          expected[col].to_numpy(dtype=np.float64), err_msg=col)
+        else:
+            np.testing.assert_array_equal(actual[col].to_numpy(), expected[col].to_numpy(), err_msg=col,
+                                          strict=True)
+    print('{}: {} rows, {} bytes, identical'.format(name, len(actual), table.nbytes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the exported records against the cleaned frames')
+    parser.add_argument('data_dir', nargs='?', default=DATA_DIR)
+    parser.add_argument('--ships', type=int, default=3, help='number of ships exported')
+    parser.add_argument('--batch-rows', type=int, default=1000, help='rows per record batch')
+    args = parser.parse_args()
+
+    ships = list_coloc_files(args.data_dir)[:args.ships]
+    cache_dir = tempfile.mkdtemp(prefix='check_export_')
+    try:
+        # a reference cache, for the expected frames only
+        reference = os.path.join(cache_dir, 'reference')
+        frame = expected_records(args.data_dir, reference, ships[:1], [(None, None)])
+        dates = frame['date'].to_numpy()
+        middle = dates[len(dates) // 2]
+        cases = {'all dates': ['/'],
+                 'two periods': ['/{}'.format(dates[len(dates) // 4]), '{}/'.format(middle)]}
+        export_cache = os.path.join(cache_dir, 'export')
+        for cache_state in ('cold cache', 'cache built'):
+            for case, values in cases.items():
+                periods = parse_periods(values)
+                expected = expected_records(args.data_dir, reference, ships, periods)
+                for fmt in ('arrow', 'parquet'):
+                    if cache_state == 'cold cache':
+                        # the export parses the ships (and writes their entries)
+                        shutil.rmtree(export_cache, ignore_errors=True)
+                    data = b''.join(stream_export(args.data_dir, export_cache, ships, periods, fmt,
+                                                  batch_rows=args.batch_rows))
+                    name = '{}, {}, {}'.format(fmt, case, cache_state)
+                    check_same(name, expected, read_export(data, fmt), fmt)
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    print('exports identical')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""In-memory stand-ins of web.models and django.db.transaction, so comp_OSIT_filt runs without the web project.
+
+The objects keep what ColocalizationProcess.save_transects writes; the cost measured for the
+DB write stage is the serialization of the transects, not the one of a database server.
+"""
+import contextlib
+import sys
+import types
+
+
+class Manager(object):
+
+    def __init__(self):
+        self.rows = []
+
+    def filter(self, **lookups):
+        rows = self.rows
+        for lookup, value in lookups.items():
+            field, _, op = lookup.partition('__')
+            if op == 'in':
+                rows = [row for row in rows if getattr(row, field) in value]
+            else:
+                rows = [row for row in rows if getattr(row, field) == value]
+        return rows
+
+    def update_or_create(self, defaults=None, **keys):
+        for row in self.filter(**keys):
+            for field, value in (defaults or {}).items():
+                setattr(row, field, value)
+            return row, False
+        row = types.SimpleNamespace(**dict(keys, **(defaults or {})))
+        self.rows.append(row)
+        return row, True
+
+
+class Dataset(types.SimpleNamespace):
+    objects = Manager()
+
+    @staticmethod
+    def name_(name):
+        return name
+
+
+class TSGProduct(types.SimpleNamespace):
+    objects = Manager()
+
+
+class TSGTransect(types.SimpleNamespace):
+    objects = Manager()
+
+
+class SatelliteTransect(types.SimpleNamespace):
+    objects = Manager()
+
+
+def atomic():
+    return contextlib.nullcontext()
+
+
+def install():
+    """Register the stand-ins in sys.modules, before comp_OSIT_filt is imported"""
+    models = types.ModuleType('web.models')
+    models.Dataset = Dataset
+    models.TSGProduct = TSGProduct
+    models.TSGTransect = TSGTransect
+    models.SatelliteTransect = SatelliteTransect
+    web = types.ModuleType('web')
+    web.models = models
+    transaction = types.ModuleType('django.db.transaction')
+    transaction.atomic = atomic
+    db = types.ModuleType('django.db')
+    db.transaction = transaction
+    django = sys.modules.get('django') or types.ModuleType('django')
+    sys.modules.update({'web': web, 'web.models': models, 'django': django, 'django.db': db,
+                        'django.db.transaction': transaction})
+
+
+def reset(tsg_product, ntransects):
+    """Empty tables, with the TSG transects of one product"""
+    for model in (Dataset, TSGProduct, TSGTransect, SatelliteTransect):
+        model.objects.rows = []
+    TSGTransect.objects.rows = [TSGTransect(index=i, tsg_product=tsg_product) for i in range(ntransects)]
@@ -0,0 +1,122 @@
+"""Synthetic inputs of the benchmarks, shaped like the real ones.
+
+- SMOS cube: v7.3 (HDF5) file with SSS (day, lat, lon) on the 0.25 degree grid and ttdayJulian
+- transects: transectTSG (transect, measure, [date, lat, lon, sal, err]), NaN padded, in a .mat (HDF5) file
+- gosud3: whitespace separated *_coloc_gosud3 files with their header line
+"""
+import os
+
+import h5py
+import numpy as np
+import pandas as pd
+
+from coloc_cache import COLUMNS
+
+# MATLAB datenum of 1970-01-01
+DATENUM_EPOCH = 719529
+# first SMOS day of the synthetic cubes, 2015-01-01
+START_DATENUM = 735965
+# TSG sampling step, one measure per minute
+TSG_STEP = 1 / 1440
+
+
+def smos_field(rng, day, nlat=720, nlon=1440):
+    """SSS (lat, lon) of one day: a smooth latitude profile, noise and land cells at 0 (no data)"""
+    lat = np.linspace(-90, 90, nlat)[:, np.newaxis]
+    lon = np.linspace(-180, 180, nlon)[np.newaxis, :]
+    sss = 35 + 1.5 * np.cos(np.deg2rad(2 * lat)) + 0.3 * np.sin(np.deg2rad(lon + day))
+    sss = sss + rng.normal(0, 0.2, (nlat, nlon))
+    sss[rng.random((nlat, nlon)) < 0.3] = 0
+    return sss.astype(np.float32)
+
+
+def make_smos_cube(filename, ndays, seed=0):
+    """Write a SMOS dataset of ndays days, chunked like smos_reader.convert_to_hdf5"""
+    rng = np.random.default_rng(seed)
+    with h5py.File(filename, 'w') as h5file:
+        sss = h5file.create_dataset('SSS', shape=(ndays, 720, 1440), dtype=np.float32, chunks=(1, 90, 180))
+        for day in range(ndays):
+            sss[day] = smos_field(rng, day)
+        h5file.create_dataset('ttdayJulian', data=np.atleast_2d(START_DATENUM + np.arange(ndays, dtype=np.float64)))
+    return filename
+
+
+def make_transects(ntransects, npoints, ndays, seed=0):
+    """transectTSG of ntransects ship tracks of up to npoints measures inside the SMOS period"""
+    rng = np.random.default_rng(seed)
+    transectTSG = np.empty((ntransects, npoints, 5))
+    transectTSG[:] = np.nan
+    for itransect in range(ntransects):
+        n = int(rng.integers(npoints // 2, npoints + 1))
+        start = START_DATENUM + rng.uniform(0, max(ndays - n * TSG_STEP - 1, 0))
+        heading = rng.uniform(0, 2 * np.pi)
+        # about 20 km/h: 0.003 degree per minute, with a wandering heading
+        heading = heading + np.cumsum(rng.normal(0, 0.02, n))
+        lat = np.clip(rng.uniform(-60, 60) + np.cumsum(0.003 * np.sin(heading)), -89, 89)
+        lon = np.mod(rng.uniform(-180, 180) + np.cumsum(0.003 * np.cos(heading)) + 180, 360) - 180
+        transectTSG[itransect, :n, 0] = start + np.arange(n) * TSG_STEP
+        transectTSG[itransect, :n, 1] = lat
+        transectTSG[itransect, :n, 2] = lon
+        transectTSG[itransect, :n, 3] = 35 + 1.5 * np.cos(np.deg2rad(2 * lat)) + rng.normal(0, 0.05, n)
+        transectTSG[itransect, :n, 4] = rng.uniform(0.01, 0.1, n)
+    return transectTSG
+
+
+def write_transect_file(filename, transectTSG):
+    """transectTSG in a MATLAB v7.3 file (stored transposed, as MATLAB does)"""
+    with h5py.File(filename, 'w') as h5file:
+        h5file.create_dataset('transectTSG', data=transectTSG.T)
+    return filename
+
+
+def make_gosud3_frame(nrows, seed=0):
+    """DataFrame with the 26 columns of a *_coloc_gosud3 file, sorted by date"""
+    rng = np.random.default_rng(seed)
+    seconds = np.sort(rng.integers(0, 3 * 365 * 86400, nrows))
+    dates = np.datetime64('2015-01-01T00:00:00') + seconds.astype('timedelta64[s]')
+    sss_argo = 35 + rng.normal(0, 1, nrows)
+    sss_tsg = sss_argo + rng.normal(0, 0.1, nrows)
+    # a few missing salinities, dropped by the parser
+    sss_argo[rng.random(nrows) < 0.02] = np.nan
+    sss_tsg[rng.random(nrows) < 0.02] = np.nan
+    frame = {
+        'date_Argo': pd.to_datetime(dates).strftime('%Y-%m-%d'),
+        'heure_Argo': pd.to_datetime(dates).strftime('%H:%M:%S'),
+        'lon': np.round(rng.uniform(-180, 180, nrows), 4),
+        'lat': np.round(rng.uniform(-70, 70, nrows), 4),
+        'numero_Argo': rng.integers(1900000, 7000000, nrows),
+        'n_profil_Argo': rng.integers(1, 300, nrows),
+        'jsp': rng.integers(0, 10, nrows),
+        'profondeur': np.round(rng.uniform(1, 10, nrows), 1),
+        'flag': rng.integers(1, 4, nrows),
+        'SSS_Argo': np.round(sss_argo, 3),
+        'flag2': rng.integers(1, 4, nrows),
+        'temp_Argo': np.round(rng.uniform(0, 30, nrows), 3),
+        'flag3': rng.integers(1, 4, nrows),
+        'profil1': rng.choice(['R', 'A', 'D'], nrows),
+        'profil2': rng.choice(['R', 'A', 'D'], nrows),
+        'difference': np.round(sss_tsg - sss_argo, 3),
+        'dist': np.round(rng.uniform(0, 50, nrows), 2),
+        'nbr_de_TSG': rng.integers(1, 100, nrows),
+        'SSS_TSG': np.round(sss_tsg, 3),
+        'STR_SSS_TSG': np.round(rng.uniform(0, 0.5, nrows), 3),
+        'donnee_eau': rng.integers(0, 100, nrows),
+        'temp_entree': np.round(rng.uniform(0, 30, nrows), 3),
+        'STR_temp_entree': np.round(rng.uniform(0, 0.5, nrows), 3),
+        'nbr_de_TSG2': rng.integers(1, 100, nrows),
+        'temp_TSG': np.round(rng.uniform(0, 30, nrows), 3),
+        'STR_temp_TSG': np.round(rng.uniform(0, 0.5, nrows), 3),
+    }
+    return pd.DataFrame(frame, columns=COLUMNS)
+
+
+def make_gosud3_files(data_dir, nships, nrows, seed=0):
+    """Write nships *_coloc_gosud3 files of nrows rows each, returns their names"""
+    os.makedirs(data_dir, exist_ok=True)
+    names = []
+    for ship in range(nships):
+        name = 'ship{:03d}_coloc_gosud3'.format(ship)
+        make_gosud3_frame(nrows, seed + ship).to_csv(os.path.join(data_dir, name), sep=' ', index=False,
+                                                     na_rep='NaN')
+        names.append(name)
+    return names
@@ -0,0 +1,317 @@
+"""Persistent columnar cache for the *_coloc_gosud3 colocation files.
+
+Each source file is parsed and cleaned once, then stored as one .npy file per
+column in cache/<file name>/, together with a meta.json holding the mtime and
+size of the source file. Later loads read the .npy columns back directly and
+only re-parse the files whose mtime or size changed.
+
+Prebuild the cache with:
+
+    python coloc_cache.py [data_dir] [--cache-dir cache/] [--force]
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+import metrics
+
+DATA_DIR = 'data/'
+CACHE_DIR = 'cache/'
+CACHE_VERSION = 2
+
+COLUMNS = ['date_Argo', 'heure_Argo', 'lon', 'lat', 'numero_Argo', 'n_profil_Argo', 'jsp', 'profondeur',
+           'flag', 'SSS_Argo', 'flag2', 'temp_Argo', 'flag3', 'profil1', 'profil2', 'difference', 'dist',
+           'nbr_de_TSG', 'SSS_TSG', 'STR_SSS_TSG', 'donnee_eau', 'temp_entree', 'STR_temp_entree',
+           'nbr_de_TSG2', 'temp_TSG', 'STR_temp_TSG']
+
+# compact in-memory schema: the raw date/time strings and the unused jsp column are dropped,
+# the remaining columns not listed here are measurements stored as float32
+DROPPED_COLUMNS = ['date_Argo', 'heure_Argo', 'jsp']
+INT_COLUMNS = {'numero_Argo': np.int32, 'n_profil_Argo': np.int16,
+               'flag': np.int8, 'flag2': np.int8, 'flag3': np.int8,
+               'nbr_de_TSG': np.int32, 'donnee_eau': np.int32, 'nbr_de_TSG2': np.int32}
+# Argo data modes (real time, adjusted, delayed); a fixed category set keeps appended rows concatenable
+PROFILE_MODES = pd.CategoricalDtype(['R', 'A', 'D'])
+CATEGORY_COLUMNS = ['profil1', 'profil2']
+# columns converted by the parser, 'difference' is recomputed from the salinities
+READ_COLUMNS = [col for col in COLUMNS if col not in ('jsp', 'difference')]
+
+# threads parsing files concurrently (the C tokenizer releases the GIL)
+PARSE_WORKERS = 4
+
+
+@lru_cache(maxsize=None)
+def mercator_transformer():
+    """lon/lat -> web mercator Transformer, created once per process (pyproj is imported on first use)"""
+    from pyproj import Transformer
+    return Transformer.from_crs(
+        "epsg:4326",
+        "epsg:3857",
+        always_xy=True,
+    )
+
+
+def parse_coloc_file(filename):
+    """Parse one colocation file and derive date, difference and mercator coordinates"""
+    # the first line is taken as a header and skipped, as the text based parse always did
+    return parse_coloc_text(filename, header=0)
+
+
+def parse_coloc_text(source, header=None):
+    """Parse colocation lines from a file name, a file object or a str.
+
+    header=0 skips the first line (start of a file), header=None keeps every line (appended lines).
+    The whitespace separated columns are tokenized straight from the source by the C parser,
+    jsp and the difference column of the file (recomputed here) are not even converted.
+    The rows are cleaned on the numpy columns, the DataFrame is built once with the compact schema.
+    """
+    if isinstance(source, str) and '\n' in source:
+        source = StringIO(source)
+    parsed = pd.read_csv(source, sep=r"\s+", header=header, names=COLUMNS, usecols=READ_COLUMNS,
+                         dtype={'date_Argo': str, 'heure_Argo': str, 'profil1': str, 'profil2': str})
+    keep = (parsed['SSS_Argo'].notna() & parsed['SSS_TSG'].notna()).to_numpy()
+    raw = {col: values.to_numpy()[keep] for col, values in parsed.items()}
+    # same column order as the files, so the schema does not depend on the parser
+    raw['difference'] = raw['SSS_TSG'] - raw['SSS_Argo']
+    columns = {col: raw[col] for col in COLUMNS if col in raw}
+    # vectorized date: the 'YYYY-MM-DD' and 'HH:MM:SS' strings joined and parsed by numpy in one pass
+    columns['date'] = (raw['date_Argo'] + 'T' + raw['heure_Argo']).astype('datetime64[ns]')
+    columns['mercatorX'], columns['mercatorY'] = mercator_transformer().transform(raw['lon'], raw['lat'])
+    return compact_columns(columns, pd.Index(np.flatnonzero(keep)))
+
+
+def parse_all(path=DATA_DIR, files=None, workers=PARSE_WORKERS):
+    """{file name: parsed DataFrame} of several files, parsed concurrently in a thread pool"""
+    files = list_coloc_files(path) if files is None else files
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = executor.map(parse_coloc_file, [os.path.join(path, f) for f in files])
+        return dict(zip(files, frames))
+
+
+def compact_coloc_frame(dfColoc):
+    """Apply the compact schema to a parsed and cleaned colocation DataFrame"""
+    return compact_columns({col: values.to_numpy() for col, values in dfColoc.items()}, dfColoc.index)
+
+
+def compact_columns(columns, index):
+    """DataFrame with the compact schema of the {column: numpy array} of parsed and cleaned rows"""
+    # one dtype mapping, applied to the numpy columns of a single new frame: assigning the
+    # columns one by one (or DataFrame.astype, column by column too) rebuilds the blocks each time
+    dtypes = {}
+    for col, values in columns.items():
+        if col == 'date' or col in DROPPED_COLUMNS:
+            continue
+        if col in CATEGORY_COLUMNS:
+            dtypes[col] = PROFILE_MODES
+        elif col in INT_COLUMNS and not pd.isna(values).any():
+            dtypes[col] = INT_COLUMNS[col]
+        else:
+            dtypes[col] = np.float32
+    data = {}
+    for col, values in columns.items():
+        if col in DROPPED_COLUMNS:
+            continue
+        if col in CATEGORY_COLUMNS:
+            values = pd.Categorical(values, dtype=dtypes[col])
+        elif col in dtypes:
+            values = values.astype(dtypes[col])
+        data[col] = values
+    return pd.DataFrame(data, index=index, columns=list(data), copy=False)
+
+
+def memory_report(datasets):
+    """Rows and in-memory bytes of each DataFrame of a {name: DataFrame} mapping, with a total line"""
+    report = pd.DataFrame({'rows': [len(df) for df in datasets.values()],
+                           'bytes': [int(df.memory_usage(deep=True).sum()) for df in datasets.values()]},
+                          index=list(datasets))
+    report.loc['total'] = report.sum()
+    return report
+
+
+def file_signature(filename):
+    """mtime and size identifying one version of a source file"""
+    st = os.stat(filename)
+    return {'mtime': st.st_mtime_ns, 'size': st.st_size}
+
+
+def write_cache(df, entry, signature):
+    """Store df column by column in the entry directory"""
+    # one temporary directory per write: the threads of a process may write the same entry
+    tmp = tempfile.mkdtemp(prefix=os.path.basename(entry) + '.tmp-', dir=os.path.dirname(entry) or '.')
+    dtypes = []
+    for i, col in enumerate(df.columns):
+        if isinstance(df[col].dtype, pd.CategoricalDtype):
+            # codes, with the categories beside them
+            dtypes.append('category')
+            np.save(os.path.join(tmp, '{:03d}.categories.npy'.format(i)),
+                    np.asarray(df[col].cat.categories).astype(str))
+            np.save(os.path.join(tmp, '{:03d}.npy'.format(i)), df[col].cat.codes.to_numpy())
+            continue
+        values = df[col].to_numpy()
+        dtypes.append(str(values.dtype))
+        if values.dtype == object:
+            # fixed-width unicode so the column can be read back without pickle
+            values = values.astype(str)
+        np.save(os.path.join(tmp, '{:03d}.npy'.format(i)), values)
+    np.save(os.path.join(tmp, 'index.npy'), df.index.to_numpy())
+    with open(os.path.join(tmp, 'meta.json'), 'w') as outfile:
+        json.dump({'version': CACHE_VERSION, 'signature': signature,
+                   'columns': list(df.columns), 'dtypes': dtypes}, outfile)
+
+    shutil.rmtree(entry, ignore_errors=True)
+    try:
+        os.rename(tmp, entry)
+    except OSError:
+        # another worker stored the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def read_meta(entry):
+    try:
+        with open(os.path.join(entry, 'meta.json')) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def is_fresh(entry, signature):
+    meta = read_meta(entry)
+    return meta is not None and meta['version'] == CACHE_VERSION and meta['signature'] == signature
+
+
+def _load_column(filename, mmap_mode):
+    try:
+        return np.load(filename, mmap_mode=mmap_mode)
+    except ValueError:
+        # an empty column cannot be memory-mapped
+        return np.load(filename)
+
+
+def read_columns(entry, signature, mmap_mode=None):
+    """{column: array} stored in entry, or None when missing or stale.
+
+    The category columns are (codes, categories) pairs, the object columns fixed-width unicode.
+    mmap_mode='r' maps the columns instead of reading them.
+    """
+    meta = read_meta(entry)
+    if meta is None or meta['version'] != CACHE_VERSION or meta['signature'] != signature:
+        return None
+    columns = {}
+    try:
+        for i, (col, dtype) in enumerate(zip(meta['columns'], meta['dtypes'])):
+            values = _load_column(os.path.join(entry, '{:03d}.npy'.format(i)), mmap_mode)
+            if dtype == 'category':
+                values = (values, np.load(os.path.join(entry, '{:03d}.categories.npy'.format(i))))
+            columns[col] = values
+    except OSError:
+        # entry replaced by another writer while it was read
+        return None
+    return columns
+
+
+def read_cache(entry, signature):
+    """DataFrame stored in entry, or None when missing or stale"""
+    columns = read_columns(entry, signature)
+    if columns is None:
+        return None
+    data = {}
+    for col, values in columns.items():
+        if isinstance(values, tuple):
+            codes, categories = values
+            values = pd.Categorical.from_codes(codes, categories=categories.astype(object))
+        elif values.dtype.kind == 'U':
+            values = values.astype(object)
+        data[col] = values
+    try:
+        index = np.load(os.path.join(entry, 'index.npy'))
+    except OSError:
+        return None
+    return pd.DataFrame(data, index=index, columns=list(columns))
+
+
+def load_coloc_file(filename, cache_dir=CACHE_DIR):
+    """Cleaned DataFrame of one colocation file, parsed only if its cache entry is stale"""
+    name = os.path.basename(filename)
+    entry = os.path.join(cache_dir, name)
+    start = time.perf_counter()
+    signature = file_signature(filename)
+    dfColoc = read_cache(entry, signature)
+    source = 'cache'
+    if dfColoc is None:
+        source = 'parse'
+        dfColoc = parse_coloc_file(filename)
+        os.makedirs(cache_dir, exist_ok=True)
+        write_cache(dfColoc, entry, signature)
+    elapsed = time.perf_counter() - start
+    metrics.observe('coloc_file_load_seconds', elapsed, source=source)
+    metrics.set_gauge('coloc_file_last_load_seconds', elapsed, file=name)
+    metrics.set_gauge('coloc_file_size_bytes', signature['size'], file=name)
+    metrics.set_gauge('coloc_file_rows', len(dfColoc), file=name)
+    return dfColoc
+
+
+def list_coloc_files(path=DATA_DIR):
+    files = os.listdir(path)
+    files.sort()
+    return files
+
+
+def load_all(path=DATA_DIR, cache_dir=CACHE_DIR, workers=PARSE_WORKERS):
+    """dict file name -> cleaned DataFrame for every file of path"""
+    files = list_coloc_files(path)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = executor.map(lambda f: load_coloc_file(os.path.join(path, f), cache_dir), files)
+        return dict(zip(files, frames))
+
+
+def build_cache(path=DATA_DIR, cache_dir=CACHE_DIR, force=False, workers=PARSE_WORKERS):
+    """Rebuild the stale entries of cache_dir and drop the ones without a source file"""
+    os.makedirs(cache_dir, exist_ok=True)
+    files = list_coloc_files(path)
+    stale = []
+    for f in files:
+        signature = file_signature(os.path.join(path, f))
+        if force or not is_fresh(os.path.join(cache_dir, f), signature):
+            stale.append((f, signature))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = executor.map(parse_coloc_file, [os.path.join(path, f) for f, _ in stale])
+        # written as the parses complete, the frames are not all kept in memory
+        for (f, signature), dfColoc in zip(stale, frames):
+            write_cache(dfColoc, os.path.join(cache_dir, f), signature)
+            print('cached {}'.format(f))
+    rebuilt = len(stale)
+    removed = 0
+    for f in os.listdir(cache_dir):
+        entry = os.path.join(cache_dir, f)
+        # only column entries (and leftovers of interrupted writes) belong to this cache
+        if f not in files and (read_meta(entry) is not None or '.tmp-' in f):
+            shutil.rmtree(entry, ignore_errors=True)
+            removed += 1
+    return rebuilt, len(files) - rebuilt, removed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Prebuild the columnar cache of the colocation files')
+    parser.add_argument('data_dir', nargs='?', default=DATA_DIR)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--force', action='store_true', help='rebuild every entry')
+    parser.add_argument('--report', action='store_true', help='print the in-memory size of every ship')
+    parser.add_argument('--workers', type=int, default=PARSE_WORKERS, help='files parsed concurrently')
+    args = parser.parse_args()
+    rebuilt, fresh, removed = build_cache(args.data_dir, args.cache_dir, args.force, args.workers)
+    print('{} rebuilt, {} up to date, {} removed'.format(rebuilt, fresh, removed))
+    if args.report:
+        print(memory_report(load_all(args.data_dir, args.cache_dir)).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""Spatial and temporal index over the colocation records of every ship.
+
+Records are bucketed in a regular lon/lat grid (1 degree cells by default) and
+sorted by cell then by date, with the offsets of each cell kept aside. A bbox
+query only scans the cells of the bbox rows it covers, and a query without
+bbox binary-searches a separate date-sorted order.
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from coloc_cache import CACHE_DIR, DATA_DIR, file_signature, list_coloc_files, load_coloc_file
+
+INDEX_COLUMNS = ['lon', 'lat', 'SSS_Argo', 'SSS_TSG', 'difference', 'dist']
+
+
+class ColocIndex(object):
+    """Grid-bucketed and date-sorted index of every *_coloc_gosud3 record"""
+
+    def __init__(self, path=DATA_DIR, cache_dir=CACHE_DIR, loader=load_coloc_file, cell=1.0):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.loader = loader
+        self.cell = cell
+        self.ncol = int(round(360 / cell))
+        self.nrow = int(round(180 / cell))
+        self.signatures = None
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _row_col(self, lon, lat):
+        col = np.clip(np.floor((np.mod(lon + 180, 360)) / self.cell).astype(np.int64), 0, self.ncol - 1)
+        row = np.clip(np.floor((lat + 90) / self.cell).astype(np.int64), 0, self.nrow - 1)
+        return row, col
+
+    def build(self):
+        """Load every ship once (without keeping the DataFrames) and build the index arrays"""
+        signatures = {f: file_signature(os.path.join(self.path, f)) for f in list_coloc_files(self.path)}
+        ships = list(signatures)
+        parts = {col: [] for col in INDEX_COLUMNS + ['date', 'ship']}
+        parts['date'].append(np.empty(0, dtype=np.int64))
+        parts['ship'].append(np.empty(0, dtype=np.int32))
+        for ship_id, f in enumerate(ships):
+            df = self.loader(os.path.join(self.path, f), self.cache_dir)
+            for col in INDEX_COLUMNS:
+                parts[col].append(df[col].to_numpy(dtype=np.float64))
+            parts['date'].append(df['date'].to_numpy().view(np.int64))
+            parts['ship'].append(np.full(len(df), ship_id, dtype=np.int32))
+        arrays = {col: np.concatenate(values) if values else np.empty(0) for col, values in parts.items()}
+
+        row, col = self._row_col(arrays['lon'], arrays['lat'])
+        cells = row * self.ncol + col
+        order = np.lexsort((arrays['date'], cells))
+        arrays = {col: values[order] for col, values in arrays.items()}
+        offsets = np.searchsorted(cells[order], np.arange(self.nrow * self.ncol + 1))
+        # date-sorted positions, for the queries without bbox
+        by_date = np.argsort(arrays['date'], kind='stable')
+        # replaced in one assignment, a query running meanwhile keeps the previous state
+        self._state = (arrays, offsets, by_date, arrays['date'][by_date], ships)
+        self.signatures = signatures
+        print('colocation index built: {} records, {} ships'.format(len(order), len(ships)))
+
+    def refresh(self):
+        """Rebuild the index if a file was added, removed or modified"""
+        with self._lock:
+            signatures = {f: file_signature(os.path.join(self.path, f)) for f in list_coloc_files(self.path)}
+            if signatures != self.signatures:
+                self.build()
+
+    def _bbox_candidates(self, offsets, lon_min, lat_min, lon_max, lat_max):
+        rows, _ = self._row_col(np.array([lon_min, lon_max]), np.array([lat_min, lat_max]))
+        row0, row1 = int(rows[0]), int(rows[1])
+        # the bbox bounds (in [-180, 180]) are not wrapped like the records: lon_max=180 is the last column
+        cols = np.clip(np.floor((np.array([lon_min, lon_max]) + 180) / self.cell).astype(np.int64), 0, self.ncol - 1)
+        col0, col1 = int(cols[0]), int(cols[1])
+        # a bbox crossing the antimeridian covers two column ranges
+        col_ranges = [(col0, col1)] if col0 <= col1 else [(col0, self.ncol - 1), (0, col1)]
+        slices = []
+        for row in range(row0, row1 + 1):
+            for c0, c1 in col_ranges:
+                # the cells of one row range are contiguous in the sorted arrays
+                begin, end = offsets[row * self.ncol + c0], offsets[row * self.ncol + c1 + 1]
+                if end > begin:
+                    slices.append(np.arange(begin, end))
+        return np.concatenate(slices) if slices else np.empty(0, dtype=np.int64)
+
+    def query(self, bbox=None, start=None, end=None, max_dist=None, max_abs_difference=None, limit=None):
+        """DataFrame of the records in bbox (lon_min, lat_min, lon_max, lat_max) and [start, end]"""
+        self.refresh()
+        arrays, offsets, by_date, sorted_dates, ships = self._state
+        start = None if start is None else np.datetime64(start, 'ns').astype(np.int64)
+        end = None if end is None else np.datetime64(end, 'ns').astype(np.int64)
+
+        if bbox is None:
+            begin = 0 if start is None else np.searchsorted(sorted_dates, start, side='left')
+            stop = len(sorted_dates) if end is None else np.searchsorted(sorted_dates, end, side='right')
+            positions = by_date[begin:stop]
+            mask = np.ones(len(positions), dtype=bool)
+        else:
+            lon_min, lat_min, lon_max, lat_max = bbox
+            positions = self._bbox_candidates(offsets, lon_min, lat_min, lon_max, lat_max)
+            lon = np.mod(arrays['lon'][positions] + 180, 360) - 180
+            lat = arrays['lat'][positions]
+            in_lon = (lon >= lon_min) & (lon <= lon_max) if lon_min <= lon_max \
+                else (lon >= lon_min) | (lon <= lon_max)
+            mask = in_lon & (lat >= lat_min) & (lat <= lat_max)
+            if start is not None:
+                mask &= arrays['date'][positions] >= start
+            if end is not None:
+                mask &= arrays['date'][positions] <= end
+
+        if max_dist is not None:
+            mask &= arrays['dist'][positions] <= max_dist
+        if max_abs_difference is not None:
+            mask &= np.abs(arrays['difference'][positions]) <= max_abs_difference
+        positions = positions[mask]
+        positions = positions[np.argsort(arrays['date'][positions], kind='stable')]
+        if limit is not None:
+            positions = positions[:limit]
+
+        result = pd.DataFrame({col: arrays[col][positions] for col in INDEX_COLUMNS})
+        result.insert(0, 'date', arrays['date'][positions].view('datetime64[ns]'))
+        result.insert(0, 'ship', np.array(ships, dtype=object)[arrays['ship'][positions]] if ships else [])
+        return result
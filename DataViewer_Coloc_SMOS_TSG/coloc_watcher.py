@@ -0,0 +1,206 @@
+"""Incremental ingestion of the lines appended to the colocation files.
+
+The *_coloc_gosud3 files only grow. The watcher remembers, for every file, the
+byte offset up to which its lines are ingested; each poll parses only the
+complete lines written after that offset, with the same schema and cleaning
+as the full parse, and hands them to the registry, the columnar cache and the
+subscribed Bokeh sessions. A line that does not parse is reported and skipped,
+and a file that fails does not stop the others.
+
+Every gunicorn worker runs its own watcher. The cache entry of a file is only
+moved forward under a lock (cache/watcher.lock): the first worker to get it
+extends the entry up to the end of the file, the others find it up to date.
+"""
+import fcntl
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from coloc_cache import (file_signature, is_fresh, load_coloc_file, parse_coloc_text, read_cache, read_meta,
+                         write_cache)
+
+POLL_INTERVAL = 10.0
+# bytes read at a time when looking for the last complete line of a file
+BLOCK_SIZE = 64 * 1024
+
+
+def last_line_end(filename, size):
+    """Offset just after the last newline in the first size bytes of filename (0 if there is none)"""
+    with open(filename, 'rb') as fichier:
+        end = size
+        while end > 0:
+            start = max(end - BLOCK_SIZE, 0)
+            fichier.seek(start)
+            newline = fichier.read(end - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+class ColocWatcher(object):
+    """Polls the files of a DatasetRegistry and ingests their appended rows"""
+
+    def __init__(self, registry, interval=POLL_INTERVAL):
+        self.registry = registry
+        self.interval = interval
+        self.offsets = {}
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, callback):
+        """callback(name, rows) is called with every batch of new cleaned rows"""
+        with self._lock:
+            self._subscribers.add(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers.discard(callback)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as error:
+                print('colocation watcher error:', repr(error))
+            time.sleep(self.interval)
+
+    def _entry(self, name):
+        return os.path.join(self.registry.cache_dir, name)
+
+    def _baseline(self, name):
+        # a fresh cache entry covers the whole file: the next line starts after its last newline,
+        # the end of a line being written is ingested once it is complete
+        filename = os.path.join(self.registry.path, name)
+        signature = file_signature(filename)
+        if not is_fresh(self._entry(name), signature):
+            load_coloc_file(filename, self.registry.cache_dir)
+            signature = file_signature(filename)
+        self.offsets[name] = last_line_end(filename, signature['size'])
+
+    def poll(self):
+        """Ingest the new complete lines of every file, returns {name: number of new rows}"""
+        ingested = {}
+        for name in self.registry.names():
+            try:
+                count = self._poll_file(name)
+            except Exception as error:
+                print('colocation watcher error on {}:'.format(name), repr(error))
+                continue
+            if count is not None:
+                ingested[name] = count
+        return ingested
+
+    def _poll_file(self, name):
+        if name not in self.offsets:
+            self._baseline(name)
+            return None
+        filename = os.path.join(self.registry.path, name)
+        size = os.stat(filename).st_size
+        offset = self.offsets[name]
+        if size == offset:
+            return None
+        if size < offset:
+            # rewritten rather than appended: back to a full load
+            self.registry.invalidate(name)
+            self._baseline(name)
+            return None
+
+        with open(filename, 'rb') as fichier:
+            fichier.seek(offset)
+            tail = fichier.read(size - offset)
+        complete = tail[:tail.rfind(b'\n') + 1]
+        if not complete:
+            return None  # a line is being written
+        # the offset moves past the new lines even if none of them parses
+        self.offsets[name] = offset + len(complete)
+        rows = self._parse_lines(name, complete.decode(errors='replace'))
+        if rows is None:
+            return 0
+        return self._ingest(name, rows, whole_file=self.offsets[name] == size)
+
+    def _parse_lines(self, name, text):
+        """Cleaned rows of complete lines, without the lines that do not parse (None if none parses)"""
+        try:
+            return parse_coloc_text(text, header=None)
+        except Exception as error:
+            print('colocation watcher: unreadable lines in {} ({!r}), parsing them one by one'.format(name, error))
+        frames = []
+        for line in text.splitlines(keepends=True):
+            if not line.strip():
+                continue
+            try:
+                frames.append(parse_coloc_text(line, header=None))
+            except Exception as error:
+                print('colocation watcher: line skipped in {}: {!r} ({!r})'.format(name, line[:80], error))
+        if not frames:
+            return None
+        return pd.concat(frames, ignore_index=True)
+
+    def _ingest(self, name, rows, whole_file):
+        # labels after the ones of the loaded DataFrame, whatever the cache entry holds
+        loaded = self.registry.loaded(name)
+        start = loaded.index.max() + 1 if loaded is not None and len(loaded) else 0
+        rows.index = np.arange(start, start + len(rows))
+        self.registry.append(name, rows)
+
+        # the cache entry can only move forward when the file ends on a complete line
+        if whole_file:
+            self._update_entry(name)
+
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(name, rows)
+        return len(rows)
+
+    def _update_entry(self, name):
+        """Extend the cache entry of name up to the end of the file, unless another worker did"""
+        filename = os.path.join(self.registry.path, name)
+        entry = self._entry(name)
+        with open(os.path.join(self.registry.cache_dir, 'watcher.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                signature = file_signature(filename)
+                if signature['size'] != self.offsets[name] or is_fresh(entry, signature):
+                    # more lines are being written, or another worker stored these ones
+                    return
+                meta = read_meta(entry)
+                cached = read_cache(entry, meta['signature']) if meta is not None else None
+                tail = None
+                if cached is not None:
+                    tail = self._entry_tail(name, meta['signature']['size'])
+                if tail is None:
+                    # no entry, or one that does not end on a line of the file: parsed again in full
+                    load_coloc_file(filename, self.registry.cache_dir)
+                else:
+                    start = cached.index.max() + 1 if len(cached) else 0
+                    for rows in tail:
+                        rows.index = np.arange(start, start + len(rows))
+                        start += len(rows)
+                    write_cache(pd.concat([cached] + [rows[cached.columns] for rows in tail]), entry, signature)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _entry_tail(self, name, entry_size):
+        """[cleaned rows] of the lines between the end of the cache entry and the ingested offset,
+        None when entry_size is not the end of a line before the offset"""
+        offset = self.offsets[name]
+        if not 0 < entry_size <= offset:
+            return None
+        with open(os.path.join(self.registry.path, name), 'rb') as fichier:
+            fichier.seek(entry_size - 1)
+            if fichier.read(1) != b'\n':
+                return None
+            tail = fichier.read(offset - entry_size)
+        rows = self._parse_lines(name, tail.decode(errors='replace')) if tail else None
+        return [] if rows is None else [rows]
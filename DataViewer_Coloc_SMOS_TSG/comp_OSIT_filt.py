@@ -1,28 +1,65 @@
-from scipy.io import loadmat
 import numpy as np
-from datetime import datetime, timedelta
-import h5py
-import xarray as xr
+from datetime import datetime
 import pandas as pd
-from math import floor
-from scipy import logical_and, spatial
+import multiprocessing
+import warnings
+from scipy import logical_and
 
+from django.db import transaction
+
+import metrics
+from smos_reader import open_smos_dataset
+from transect_store import TransectStore, open_transect_store, read_transect_file
 from web.models import Dataset, TSGTransect, SatelliteTransect
 
 
+# MATLAB datenum of 1970-01-01, the datetime64 epoch
+DATENUM_EPOCH = 719529
+US_PER_DAY = 86400 * 10 ** 6
+
+
+def datenum_to_datetime64(datenums):
+    """datetime64[us] array of MATLAB datenums, NaT where NaN.
+
+    The fraction of day is rounded to the microsecond (half to even) like timedelta(days=datenum % 1).
+    """
+    datenums = np.asarray(datenums, dtype=np.float64)
+    valid = ~np.isnan(datenums)
+    values = np.where(valid, datenums, 0)
+    days = np.floor(values)
+    us = (days.astype(np.int64) - DATENUM_EPOCH) * US_PER_DAY \
+        + np.round((values - days) * US_PER_DAY).astype(np.int64)
+    dates = us.astype('datetime64[us]')
+    dates[~valid] = np.datetime64('NaT')
+    return dates
+
+
+def datetime64_to_datenum(dates):
+    """MATLAB datenums of datetime64 values, NaN where NaT"""
+    dates = np.asarray(dates, dtype='datetime64[us]')
+    datenums = dates.astype(np.int64) / US_PER_DAY + DATENUM_EPOCH
+    return np.where(np.isnat(dates), np.nan, datenums)
+
+
 def matlab_date_to_datetime(datev):
-    return pd.NaT if np.isnan(datev) \
-        else datetime.fromordinal(int(datev)) + timedelta(days=datev % 1) - timedelta(days=366)
+    """datetime of one MATLAB datenum, NaT if NaN"""
+    return pd.NaT if np.isnan(datev) else datenum_to_datetime64(datev).item()
 
 
 def datevec(d):
-    """datetime d to vector (d.year, d.month, d.day, d.hour, d.minute, d.second)"""
-    def datetime2vector(d):
-        return [d.year, d.month, d.day, d.hour, d.minute, d.second]
-
-    if isinstance(d, float):
-        d = np.array([d])
-    return np.array([datetime2vector(matlab_date_to_datetime(x)) for x in d])
+    """MATLAB datenums d to rows (year, month, day, hour, minute, second), NaN rows for NaN dates"""
+    dates = datenum_to_datetime64(np.atleast_1d(d))
+    days = dates.astype('datetime64[D]')
+    months = dates.astype('datetime64[M]')
+    seconds = (dates - days).astype('timedelta64[s]').astype(np.int64)
+    vectors = np.column_stack([months.astype('datetime64[Y]').astype(np.int64) + 1970,
+                               months.astype(np.int64) % 12 + 1,
+                               (days - months.astype('datetime64[D]')).astype(np.int64) + 1,
+                               seconds // 3600, seconds // 60 % 60, seconds % 60])
+    if np.isnat(dates).any():
+        vectors = vectors.astype(np.float64)
+        vectors[np.isnat(dates)] = np.nan
+    return vectors
 
 
 def great_circle(pt1, pt2):
@@ -36,6 +73,108 @@ def great_circle(pt1, pt2):
     return np.rad2deg(dist)[:, np.newaxis]
 
 
+def mean_average_tsg(unTSG, dnearc, dmeanc, tmeanc):
+    """Mean-average the TSG measures (date, lat, lon, sal, err) of one transect.
+
+    A measure opens a new average when both its grid latitude and longitude differ from the
+    ones of the previous average. The average covers the measures closer than dmeanc (degree)
+    to that grid point and than tmeanc (day) to the measure. Only the measures of a sorted time
+    window are compared, instead of the whole transect for each measure.
+    Returns un2TSG: (date, lat, lon, mean sal, mean err, std sal), NaN padded.
+    """
+    nmesure = unTSG.shape[0]
+    un2TSG = np.empty((nmesure, 6))
+    un2TSG[:] = np.nan
+    if nmesure <= 1:
+        return un2TSG
+
+    latc = ((np.round((unTSG[:, 1] + 90) * 4)) / 4 - 90) - dnearc
+    lonc = ((np.round((unTSG[:, 2] + 180) * 4)) / 4 - 180) - dnearc
+
+    # the grid-cell dedup only compares scalars with the previous kept cell
+    kept = []
+    latc_used = 0
+    lonc_used = 0
+    for imesure, (lat, lon) in enumerate(zip(latc.tolist(), lonc.tolist())):
+        if latc_used != lat and lonc_used != lon:
+            kept.append(imesure)
+            latc_used = lat
+            lonc_used = lon
+    kept = np.array(kept, dtype=int)
+
+    # candidate window slightly wider than tmeanc, the exact test is done on the candidates
+    order = np.argsort(unTSG[:, 0], kind='stable')
+    sorted_dates = unTSG[order, 0]
+    margin = 1e-6
+    begins = np.searchsorted(sorted_dates, unTSG[kept, 0] - tmeanc - margin, side='left')
+    ends = np.searchsorted(sorted_dates, unTSG[kept, 0] + tmeanc + margin, side='right')
+
+    for isupmesure, (imesure, begin, end) in enumerate(zip(kept, begins, ends)):
+        # transect order, so that the means are summed in the same order as over the full transect
+        candidates = np.sort(order[begin:end])
+        dist_center = great_circle(unTSG[candidates, 1:3], np.array([[latc[imesure], lonc[imesure]]]))[:, 0]
+        time_center = np.abs(unTSG[imesure, 0] - unTSG[candidates, 0])
+        round_sal = candidates[logical_and(dist_center < dmeanc, time_center < tmeanc)]
+        un2TSG[isupmesure, 0] = unTSG[imesure, 0]
+        un2TSG[isupmesure, 1] = unTSG[imesure, 1]
+        un2TSG[isupmesure, 2] = unTSG[imesure, 2]
+        un2TSG[isupmesure, 3] = np.mean(unTSG[round_sal, 3])
+        un2TSG[isupmesure, 4] = np.mean(unTSG[round_sal, 4])
+        un2TSG[isupmesure, 5] = np.nanstd(unTSG[round_sal, 3])
+
+    return un2TSG
+
+
+def nearest_day(dateSSS, dates):
+    """Index of the nearest SMOS day (sorted ttdayJulian) of each date, in one batch.
+
+    Dates more than 2 days before the SMOS period get 0 and the ones more than 2 days after
+    get len(dateSSS) + 1, both outside the valid range 1..len(dateSSS) used by the lookup.
+    Ties between two days go to the earlier one.
+    """
+    d_long = dateSSS.shape[0]
+    if d_long == 1:
+        nbday = np.zeros(dates.shape, dtype=int)
+    else:
+        right = np.clip(np.searchsorted(dateSSS, dates), 1, d_long - 1)
+        left = right - 1
+        nbday = np.where(np.abs(dates - dateSSS[left]) <= np.abs(dateSSS[right] - dates), left, right)
+    nbday[dates > dateSSS[-1] + 2] = d_long + 1
+    nbday[dates < dateSSS[0] - 2] = 0
+    return nbday
+
+
+def smos_grid_indices(lat, lon, ngrid_coloc):
+    """1-based (lon, lat) indices on the (1440, 720) grid of the box around each point, shape (n, k)"""
+    ilati = np.where(lat == -90, 720, np.floor((lat + 90) / 0.25))
+    ilong = np.where(lon == -180, 1440, np.floor((lon + 180) / 0.25))
+    ilati = np.nan_to_num(ilati).astype(int)
+    ilong = np.nan_to_num(ilong).astype(int)
+
+    # Détermination des domaines des indices lon/lat à couvrir
+    offsets = np.array([0]) if ngrid_coloc == 0 else np.arange(-ngrid_coloc, ngrid_coloc)
+    rangelon = np.mod(ilong[:, np.newaxis] + offsets, 1440)
+    rangelon[rangelon == 0] = 1440
+    rangelat = np.mod(ilati[:, np.newaxis] + offsets, 720)
+    rangelat[rangelat == 0] = 720
+    return rangelon, rangelat
+
+
+def smos_box_mean(SSS_smos, lat, lon, nbday, ngrid_coloc):
+    """Mean SMOS salinity of the box around each point on its day nbday, NaN outside of the SMOS period"""
+    d_long = SSS_smos.shape[-1]
+    rangelon, rangelat = smos_grid_indices(lat, lon, ngrid_coloc)
+    valid = logical_and(logical_and(nbday > 0, nbday <= d_long), np.isfinite(lat) & np.isfinite(lon))
+    sal = np.empty(lat.shape)
+    sal[:] = np.nan
+    # Calcul de la moyenne des salinités dans une boite ngrid_coloc × (+/-0.25°) par rapport au centre
+    SSSz = SSS_smos[rangelon[valid] - 1, rangelat[valid] - 1, nbday[valid][:, np.newaxis]]
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        sal[valid] = np.nanmean(SSSz, axis=1)
+    return sal
+
+
 class ColocalizationProcess(object):
     """Processus of colocalization"""
     transect_dir = 'LSAT-DATA/transects/{}'
@@ -48,7 +187,7 @@ class ColocalizationProcess(object):
     moisoriSSS = np.array([2010, 7, 1])
 
     def __init__(self, meanr_ave, tsg_product, dataset, orbit_type, transects, limdate_in, limdate_out, user,
-                 min_length, progress_recorder):
+                 min_length, progress_recorder, workers=1):
         self.meanr_ave = meanr_ave
         self.tsg_product = tsg_product
         self.dataset = dataset
@@ -61,6 +200,7 @@ class ColocalizationProcess(object):
         self.orbit_type = orbit_type
         self.progress_recorder = progress_recorder
         self.user = user
+        self.workers = workers  # number of processes colocating the transects in parallel
 
         if meanr_ave == 25:
             self.dnearc = 0.125  # maximum distance (degree) from TSG's mesure to keep a satellite data
@@ -86,159 +226,151 @@ class ColocalizationProcess(object):
             self.dataset, self.transect_file, self.orbit_type, self.str_dmeanc, self.min_length))
 
     def process(self):
-        mat = loadmat(self.dataset_file)
-        SSS_smos3 = mat['SSS']
-        d3_long = mat['SSS'].shape[-1]
+        with metrics.span('coloc_process_stage_seconds', stage='total'):
+            return self._process()
+
+    def _process(self):
+        # Only the (lon, lat, day) cells met by the transects are read from v7.3 (HDF5) files
+        with metrics.span('coloc_process_stage_seconds', stage='load_smos'):
+            dateSSS3, SSS_smos3 = open_smos_dataset(self.dataset_file)
+        d3_long = SSS_smos3.shape[-1]
         print('Input 3 : {}, {}; {} samples'.format(self.leg_SMOS, self.dataset_file, d3_long))
-        dateSSS3 = np.squeeze(mat['ttdayJulian'])
-        SSS_smos3[SSS_smos3 == 0] = np.nan
 
         print('time frame: {}---{}'.format(self.limdate_in, self.limdate_out))
 
-        # Read transect file
-        if self.transect_file.endswith('.mat'):
-            with h5py.File(self.transect_file, 'r') as tf:
-                transectTSG = np.array(tf['transectTSG']).T
-        elif self.transect_file.endswith('.nc'):
-            ds = xr.open_dataset(self.transect_file)
-            transectTSG = ds['transectTSG'].values
-            ds.close()
-        else:
-            print('*** Unknown transect file format! {}'.format(self.transect_file))
-            raise
-
-        print('TransectTSG: {} is loaded'.format(self.transect_file))
-        nbtransect = transectTSG.shape[0]
-        txt_date = np.tile('____________________________________________________', nbtransect)
-        for itransect in self.transects:
-            nonan = ~np.isnan(transectTSG[itransect, :, 0])
-            fnonan = np.nonzero(nonan == 1)
-            jourref = transectTSG[itransect, fnonan[0][0], 0]
-            jourmesure = transectTSG[itransect, fnonan[0][-1], 0]
-            txt_date[itransect] = '{} -- {}'.format(matlab_date_to_datetime(jourref),
-                                                    matlab_date_to_datetime(jourmesure))
+        # Transects: only the selected ones are read from a converted store (transect_store.py),
+        # the files without store are read whole and indexed in memory
+        with metrics.span('coloc_process_stage_seconds', stage='load_transects'):
+            transects = open_transect_store(self.transect_file)
+            if transects is None:
+                transects = TransectStore.from_array(read_transect_file(self.transect_file))
+                print('TransectTSG: {} is loaded'.format(self.transect_file))
+            else:
+                print('TransectTSG: {} is indexed'.format(self.transect_file))
+
+        # the date limits only look at the index
+        date_in = None if not self.limdate_in else datetime64_to_datenum(np.datetime64(self.limdate_in, 'D'))
+        date_out = None if not self.limdate_out else \
+            datetime64_to_datenum(np.datetime64(self.limdate_out, 'D') + np.timedelta64(1, 'D'))
+        selected = transects.select(self.transects, date_in, date_out)
+        print('{} of {} transects in the time frame'.format(len(selected), len(self.transects)))
+
+        first, last = transects.date_bounds(selected)
+        txt_date = {itransect: '{} -- {}'.format(dateref, datemesure) for itransect, dateref, datemesure in
+                    zip(selected, datenum_to_datetime64(first).tolist(), datenum_to_datetime64(last).tolist())}
 
         print('Data ok: {}'.format(datetime.now()))
 
-        for i, itransect in enumerate(self.transects):
-
-            full_mth = datevec(transectTSG[itransect, :, 0])
-            date_ok = np.arange(0, len(full_mth[:, 1]))[:, np.newaxis]
-            unTSG = np.empty((np.sum(~np.isnan(transectTSG[itransect, date_ok, 0])), 1))
-            unTSG[:] = np.nan
-            unTSG = transectTSG[itransect, range(len(unTSG)), :]
-            un2TSG = np.empty((unTSG.shape[0], 6))
-            un2TSG[:] = np.nan
-
-            transect_name = '** itransect = {}; Nb pts {}; dates: {}; {}-{} **'.format(
-                itransect, unTSG.shape[0], txt_date[itransect], self.tsg_product, self.dataset)
-
-            print(transect_name)
-
-            isupmesure = -1
-            latc_used = 0
-            lonc_used = 0
-
-            # Boucle sur le nombre de mesures du transect en cours
-            for imesure in range(unTSG.shape[0]):
-                latc = ((round((unTSG[imesure, 1] + 90) * 4)) / 4 - 90) - self.dnearc
-                lonc = ((round((unTSG[imesure, 2] + 180) * 4)) / 4 - 180) - self.dnearc
-                if latc_used != latc and lonc_used != lonc:
-                    replatc = np.tile(latc, (unTSG.shape[0], 1))
-                    replonc = np.tile(lonc, (unTSG.shape[0], 1))
-                    repdate = np.tile(unTSG[imesure, 0], (unTSG.shape[0], 1))
-                    if not unTSG[:, 1].shape == (1, ):
-                        dist_center = great_circle(np.squeeze(np.dstack((unTSG[:, 1], unTSG[:, 2]))),
-                                                   np.squeeze(np.dstack((replatc, replonc))))
-                        time_center = np.abs(repdate - unTSG[:, 0][..., np.newaxis])
-                        round_sal = np.nonzero(logical_and(dist_center < self.dmeanc, time_center < self.tmeanc))[0]
-                        isupmesure += 1
-                        un2TSG[isupmesure, 0] = unTSG[imesure, 0]
-                        un2TSG[isupmesure, 1] = unTSG[imesure, 1]
-                        un2TSG[isupmesure, 2] = unTSG[imesure, 2]
-                        un2TSG[isupmesure, 3] = np.mean(unTSG[round_sal, 3])
-                        un2TSG[isupmesure, 4] = np.mean(unTSG[round_sal, 4])
-                        un2TSG[isupmesure, 5] = np.nanstd(unTSG[round_sal, 3])
-                        latc_used = latc
-                        lonc_used = lonc
-                    else:
-                        isupmesure += 1
-                        un2TSG[isupmesure, :] = np.nan
-
-            # Nouveau unTSG qui correspond maintenant aux seules mesures moyennées TSG
-            unTSG = np.empty((np.sum(~np.isnan(un2TSG[:, 0])), 1))
-            unTSG = un2TSG[range(unTSG.shape[0]), :]
-
-            # Déclaration matrices SMOS et ISAS
-            sal3 = np.squeeze(np.empty((1, unTSG.shape[0])))
-            if unTSG.shape[0] <= 1:
-                continue
-            sal3[:] = np.nan
-
-            for imesure in range(unTSG.shape[0]):
-                # Boucle sur le nombre de mesures du transect en cours
-                # Pour des localisations à 0.25°, sur la grille (1440,720)
-
-                # 1. Déterminer les bandes pour lesquelles le point de grille pour SSSsmos est rempli
-                #    travail sur la dateTSG (positions valides grille) et médiane med_SSS
-
-                if unTSG[imesure, 1] == -90:
-                    ilati = 720
-                else:
-                    ilati = floor((unTSG[imesure, 1] + 90) / 0.25)
-                if unTSG[imesure, 2] == -180:
-                    ilong = 1440
-                else:
-                    ilong = floor((unTSG[imesure, 2] + 180) / 0.25)
-
-                # dk nbday for new dataset. Taking number 3 of v622
-                if unTSG[imesure, 0] > dateSSS3[-1] + 2:
-                    nbdaySSS3 = d3_long + 1
-                elif unTSG[imesure, 0] < dateSSS3[0] - 2:
-                    nbdaySSS3 = 0
-                else:
-                    nbdaySSS3 = spatial.KDTree(dateSSS3[:, np.newaxis]).query([unTSG[imesure, 0]])[1]
-
-                # Détermination des domaines des indices lon/lat à couvrir
-                indicelgbeg = ilong - self.ngrid_coloc
-                indicelgend = ilong + self.ngrid_coloc
-                rangelon = np.mod(
-                    np.array([[indicelgbeg]]) if indicelgbeg == indicelgend
-                    else np.arange(indicelgbeg, indicelgend)[:, np.newaxis], 1440)
-                rangelon[np.nonzero(rangelon == 0)[0]] = 1440
-
-                indiceltbeg = ilati - self.ngrid_coloc
-                indiceltend = ilati + self.ngrid_coloc
-                rangelat = np.mod(
-                    np.array([[indiceltbeg]]) if indiceltbeg == indiceltend
-                    else np.arange(indiceltbeg, indiceltend)[:, np.newaxis], 720)
-                rangelat[np.nonzero(rangelat == 0)[0]] = 720
-
-                # Calcul de la moyenne des salinités dans une boite ngrid_coloc × (+/-0.25°) par rapport au centre
-                if nbdaySSS3 > 0 and nbdaySSS3 <= d3_long:
-                    SSSz3 = SSS_smos3[rangelon - 1, rangelat - 1, nbdaySSS3]
-                    sal3[imesure] = np.mean(SSSz3[~np.isnan(SSSz3)])
+        # with several workers the tsg_average and smos_lookup stages are timed in the pool processes,
+        # the colocate stage is the wall time of all the transects
+        with metrics.span('coloc_process_stage_seconds', stage='colocate'):
+            if self.workers > 1 and len(selected) > 1:
+                # the workers are forked: they share the transect store (and an in-memory SMOS cube) copy-on-write
+                SSS_smos3.close()
+                global _worker_state
+                _worker_state = (self, dateSSS3, SSS_smos3, transects, txt_date)
+                pool = multiprocessing.get_context('fork').Pool(min(self.workers, len(selected)),
+                                                                 initializer=_init_worker)
+                try:
+                    results = self._collect(pool.imap(_colocate_worker, selected), len(selected))
+                except BaseException:
+                    # cancelled job or failed transect: the remaining transects are not waited for
+                    pool.terminate()
+                    raise
                 else:
-                    sal3[imesure] = np.nan
-
-            tdict = dict((n, v.tolist()) for n, v in
-                         zip(['fulldateTSG', 'fulllatTSG', 'fulllonTSG', 'fullsalTSG', 'fullerrTSG'], unTSG.T))
-
-            tsg_transect = TSGTransect.objects.get(index=itransect, tsg_product=self.tsg_product)
-
-            transect, created = SatelliteTransect.objects.update_or_create(
-                dataset=self.dataset,
-                tsg_transect=tsg_transect,
-                defaults={'text_title': transect_name,
-                          'description': '',
-                          'salinities': np.squeeze(sal3).tolist(),
-                          'tsg_longitudes': tdict['fulllonTSG'],
-                          'tsg_latitudes': tdict['fulllatTSG'],
-                          'tsg_dates': list(map(matlab_date_to_datetime, tdict['fulldateTSG'])),
-                          'tsg_salinities': tdict['fullsalTSG'],
-                          'tsg_std': tdict['fullerrTSG'],
-                          'creator': self.user
-                          }
-            )
-
-            self.progress_recorder.set_progress(i + 1, len(self.transects))
+                    pool.close()
+                finally:
+                    pool.join()
+                    _worker_state = None
+            else:
+                results = self._collect((self.colocate_transect(itransect, dateSSS3, SSS_smos3,
+                                                                transects.samples(itransect), txt_date[itransect])
+                                         for itransect in selected), len(selected))
+                SSS_smos3.close()
+
+        with metrics.span('coloc_process_stage_seconds', stage='db_write'):
+            self.save_transects(results)
+        return results
+
+    def _collect(self, results, total):
+        """Keep the colocated transects in the order of the selection and report the progress"""
+        kept = []
+        for i, result in enumerate(results):
+            if result is not None:
+                kept.append(result)
+            self.progress_recorder.set_progress(i + 1, total)
+        return kept
+
+    def colocate_transect(self, itransect, dateSSS3, SSS_smos3, unTSG, txt_date):
+        """(itransect, transect_name, averaged TSG measures, SMOS salinities) of one transect, None if too short
+
+        unTSG holds the valid measures of the transect (TransectStore.samples), txt_date its date label.
+        """
+        transect_name = '** itransect = {}; Nb pts {}; dates: {}; {}-{} **'.format(
+            itransect, unTSG.shape[0], txt_date, self.tsg_product, self.dataset)
+
+        print(transect_name)
+
+        # Moyenne des mesures TSG autour de chaque nouveau point de grille du transect
+        with metrics.span('coloc_process_stage_seconds', stage='tsg_average'):
+            un2TSG = mean_average_tsg(unTSG, self.dnearc, self.dmeanc, self.tmeanc)
+
+        # Nouveau unTSG qui correspond maintenant aux seules mesures moyennées TSG
+        unTSG = np.empty((np.sum(~np.isnan(un2TSG[:, 0])), 1))
+        unTSG = un2TSG[range(unTSG.shape[0]), :]
+
+        # Déclaration matrices SMOS et ISAS
+        if unTSG.shape[0] <= 1:
+            return None
+
+        # Pour des localisations à 0.25°, sur la grille (1440,720) : jour SMOS le plus proche
+        # puis moyenne des salinités de la boite, pour toutes les mesures du transect à la fois
+        with metrics.span('coloc_process_stage_seconds', stage='smos_lookup'):
+            nbdaySSS3 = nearest_day(dateSSS3, unTSG[:, 0])
+            sal3 = smos_box_mean(SSS_smos3, unTSG[:, 1], unTSG[:, 2], nbdaySSS3, self.ngrid_coloc)
+
+        return itransect, transect_name, unTSG, sal3
+
+    def save_transects(self, results):
+        """Write the colocated transects in one transaction"""
+        if not results:
+            return
+        tsg_transects = {t.index: t for t in TSGTransect.objects.filter(
+            index__in=[result[0] for result in results], tsg_product=self.tsg_product)}
+
+        with transaction.atomic():
+            for itransect, transect_name, unTSG, sal3 in results:
+                tdict = dict((n, v.tolist()) for n, v in
+                             zip(['fulldateTSG', 'fulllatTSG', 'fulllonTSG', 'fullsalTSG', 'fullerrTSG'], unTSG.T))
+
+                transect, created = SatelliteTransect.objects.update_or_create(
+                    dataset=self.dataset,
+                    tsg_transect=tsg_transects[itransect],
+                    defaults={'text_title': transect_name,
+                              'description': '',
+                              'salinities': np.squeeze(sal3).tolist(),
+                              'tsg_longitudes': tdict['fulllonTSG'],
+                              'tsg_latitudes': tdict['fulllatTSG'],
+                              'tsg_dates': datenum_to_datetime64(unTSG[:, 0]).tolist(),
+                              'tsg_salinities': tdict['fullsalTSG'],
+                              'tsg_std': tdict['fullerrTSG'],
+                              'creator': self.user
+                              }
+                )
+
+
+# state of the parent process, inherited by the forked workers of ColocalizationProcess.process
+_worker_state = None
+
+
+def _init_worker():
+    global _worker_state
+    process, dateSSS3, SSS_smos3, transects, txt_date = _worker_state
+    # each worker opens its own handle on the SMOS file
+    _worker_state = (process, dateSSS3, SSS_smos3.reopen(), transects, txt_date)
+
+
+def _colocate_worker(itransect):
+    process, dateSSS3, SSS_smos3, transects, txt_date = _worker_state
+    return process.colocate_transect(itransect, dateSSS3, SSS_smos3, transects.samples(itransect),
+                                     txt_date[itransect])
@@ -0,0 +1,102 @@
+"""On-demand access to the ship datasets with a bounded LRU memory budget"""
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+from coloc_cache import CACHE_DIR, DATA_DIR, list_coloc_files, load_coloc_file
+
+# default memory budget of the loaded DataFrames in one worker
+MEMORY_LIMIT = 256 * 1024 * 1024
+
+
+class DatasetRegistry(object):
+    """Ship DataFrames loaded on first access and evicted least recently used first"""
+
+    def __init__(self, path=DATA_DIR, cache_dir=CACHE_DIR, memory_limit=MEMORY_LIMIT, loader=load_coloc_file):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.memory_limit = memory_limit
+        self.loader = loader
+        self._frames = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def names(self):
+        """File names available in the data directory, without loading them"""
+        return list_coloc_files(self.path)
+
+    def __contains__(self, name):
+        return name in self.names()
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def get(self, name):
+        with self._lock:
+            if name in self._frames:
+                self._frames.move_to_end(name)
+                self.hits += 1
+                return self._frames[name]
+            self.misses += 1
+
+        if name not in self.names():
+            raise KeyError(name)
+        df = self.loader(os.path.join(self.path, name), self.cache_dir)
+        size = int(df.memory_usage(deep=True).sum())
+
+        with self._lock:
+            if name not in self._frames:
+                self._frames[name] = df
+                self._sizes[name] = size
+            self._frames.move_to_end(name)
+            self._evict()
+            return self._frames.get(name, df)
+
+    def loaded(self, name):
+        """DataFrame of name if it is in memory, without loading it"""
+        with self._lock:
+            return self._frames.get(name)
+
+    def append(self, name, rows):
+        """Add rows to an in-memory dataset, returns the new DataFrame or None if it is not loaded"""
+        with self._lock:
+            if name not in self._frames:
+                return None
+            df = pd.concat([self._frames[name], rows[self._frames[name].columns]])
+            self._frames[name] = df
+            self._sizes[name] = int(df.memory_usage(deep=True).sum())
+            self._evict()
+            return df
+
+    def invalidate(self, name=None):
+        """Forget one loaded dataset, or all of them"""
+        with self._lock:
+            for key in ([name] if name is not None else list(self._frames)):
+                self._frames.pop(key, None)
+                self._sizes.pop(key, None)
+
+    def _evict(self):
+        # the most recently used dataset is kept even if it alone exceeds the budget
+        while len(self._frames) > 1 and self.memory_usage() > self.memory_limit:
+            name, _ = self._frames.popitem(last=False)
+            self._sizes.pop(name)
+            self.evictions += 1
+
+    def memory_usage(self):
+        return sum(self._sizes.values())
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'loaded': dict(self._sizes),
+                    'memory_usage': self.memory_usage(),
+                    'memory_limit': self.memory_limit,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hit_ratio': self.hits / total if total else 0.0}
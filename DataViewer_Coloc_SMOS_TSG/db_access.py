@@ -0,0 +1,87 @@
+"""Access to database.db shared by db_functions and jobs.
+
+Each thread keeps one connection open instead of connecting for every query,
+so the statements prepared by sqlite3 (cached per connection) are reused. The
+database is in WAL mode: readers do not block the writer of another gunicorn
+worker, and a busy database is waited for up to BUSY_TIMEOUT seconds.
+
+The connections are in autocommit mode, transaction() groups statements.
+Queries only take values as ? parameters.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+DATABASE = 'database.db'
+BUSY_TIMEOUT = 30
+# prepared statements kept per connection
+CACHED_STATEMENTS = 256
+
+_local = threading.local()
+# connections inherited through a fork: never used nor closed by the child (it would release the parent locks)
+_inherited = []
+
+
+def connection():
+    """Connection of the current thread, opened on first use"""
+    pid, conn = getattr(_local, 'connection', (None, None))
+    if conn is not None and pid != os.getpid():
+        _inherited.append(conn)
+        conn = None
+    if conn is None:
+        conn = sqlite3.connect(DATABASE, timeout=BUSY_TIMEOUT, isolation_level=None,
+                               cached_statements=CACHED_STATEMENTS)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute('PRAGMA synchronous=NORMAL;')
+        conn.execute('PRAGMA busy_timeout={:d};'.format(BUSY_TIMEOUT * 1000))
+        _local.connection = (os.getpid(), conn)
+    return conn
+
+
+def close():
+    """Close the connection of the current thread"""
+    pid, conn = getattr(_local, 'connection', (None, None))
+    if conn is not None:
+        if pid == os.getpid():
+            conn.close()
+        else:
+            _inherited.append(conn)
+    _local.connection = (None, None)
+
+
+@contextmanager
+def transaction(immediate=False):
+    """Connection with an open transaction, committed at the end of the block or rolled back on error.
+
+    immediate=True takes the write lock at once, for read-then-write sequences.
+    """
+    conn = connection()
+    conn.execute('BEGIN IMMEDIATE;' if immediate else 'BEGIN;')
+    try:
+        yield conn
+        conn.execute('COMMIT;')
+    except BaseException:
+        # a failed COMMIT (busy database) leaves the transaction open on the pooled connection
+        if conn.in_transaction:
+            conn.execute('ROLLBACK;')
+        raise
+
+
+def execute(query, params=()):
+    """Run one statement, returns its cursor"""
+    return connection().execute(query, params)
+
+
+def executemany(query, seq_of_params):
+    """Run one statement for each parameter tuple, in a single transaction"""
+    with transaction() as conn:
+        return conn.executemany(query, seq_of_params)
+
+
+def fetchall(query, params=()):
+    return connection().execute(query, params).fetchall()
+
+
+def fetchone(query, params=()):
+    return connection().execute(query, params).fetchone()
@@ -1,67 +1,194 @@
+import hashlib
+import json
 import sqlite3
-from comp_OSIT_filt import *
+import time
+import zlib
+from operator import itemgetter
 
+import numpy as np
 
+import db_access
+import metrics
+
+
+@metrics.timed('sqlite_query_seconds', operation='initialize_db')
 def initialize_db():
     try:
-        sqliteConnection = sqlite3.connect('database.db')
-        sqliteConnection.execute('CREATE TABLE IF NOT EXISTS coloc_files(meanr_ave VARCHAR, tsg_product VARCHAR NOT '
-                                 'NULL, dataset VARCHAR NOT NULL, orbit_type VARCHAR NOT NULL, transects VARCHAR NOT '
-                                 'NULL, limdate_in VARCHAR NOT NULL, limdate_out VARCHAR NOT NULL, user VARCHAR, '
-                                 'min_length FLOAT NOT NULL, progress_recorder BOOLEAN NOT NULL, result VARCHAR);')
+        with db_access.transaction() as sqliteConnection:
+            sqliteConnection.execute('CREATE TABLE IF NOT EXISTS coloc_files(meanr_ave VARCHAR, tsg_product VARCHAR '
+                                     'NOT NULL, dataset VARCHAR NOT NULL, orbit_type VARCHAR NOT NULL, transects '
+                                     'VARCHAR NOT NULL, limdate_in VARCHAR NOT NULL, limdate_out VARCHAR NOT NULL, '
+                                     'user VARCHAR, min_length FLOAT NOT NULL, progress_recorder BOOLEAN NOT NULL, '
+                                     'result VARCHAR);')
+            sqliteConnection.execute('CREATE TABLE IF NOT EXISTS coloc_results(key TEXT PRIMARY KEY, params TEXT NOT '
+                                     'NULL, size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL);')
+            sqliteConnection.execute('CREATE TABLE IF NOT EXISTS coloc_result_transects(key TEXT NOT NULL, '
+                                     'position INTEGER NOT NULL, itransect INTEGER NOT NULL, name TEXT, '
+                                     'data BLOB NOT NULL, PRIMARY KEY (key, position));')
+            sqliteConnection.execute('CREATE TABLE IF NOT EXISTS coloc_jobs(id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                                     'key TEXT NOT NULL, params TEXT NOT NULL, state TEXT NOT NULL, current INTEGER, '
+                                     'total INTEGER, error TEXT, created REAL NOT NULL, updated REAL NOT NULL, '
+                                     'owner INTEGER);')
+            # pid of the process owning the job, added to the tables created without it
+            columns = [row[1] for row in sqliteConnection.execute('PRAGMA table_info(coloc_jobs);')]
+            if 'owner' not in columns:
+                sqliteConnection.execute('ALTER TABLE coloc_jobs ADD COLUMN owner INTEGER;')
+            # lookup columns: in-flight jobs of a request key, least recently used results
+            sqliteConnection.execute('CREATE INDEX IF NOT EXISTS coloc_jobs_key_state ON coloc_jobs(key, state);')
+            sqliteConnection.execute('CREATE INDEX IF NOT EXISTS coloc_results_last_access '
+                                     'ON coloc_results(last_access);')
     except sqlite3.Error as error:
-        print("Failed to insert multiple records into sqlite table", error)
-    finally:
-        if sqliteConnection:
-            sqliteConnection.close()
+        print("Failed to initialize the sqlite tables", error)
 
 
-def read_sqlite_table(sqlite_select_query):
+@metrics.timed('sqlite_query_seconds', operation='read_sqlite_table')
+def read_sqlite_table(sqlite_select_query, params=()):
+    """First column of the rows of a select query, values passed as ? parameters"""
     rows = []
     try:
-        sqliteConnection = sqlite3.connect('database.db')
-        cursor = sqliteConnection.cursor()
-        cursor.execute(sqlite_select_query)
-        records = cursor.fetchall()
+        records = db_access.fetchall(sqlite_select_query, params)
         print("Total rows are:  ", len(records), "\n\n")
-        for row in records:
-            rows.append(row[0])
-        cursor.close()
-
+        rows = list(map(itemgetter(0), records))
     except sqlite3.Error as error:
         print("Failed to read data from sqlite table", error)
-    finally:
-        if sqliteConnection:
-            sqliteConnection.close()
     return rows
 
 
-def add_coloc_db(coloc_info):
+# result cache: limits applied by evict_results after each stored colocation
+RESULT_CACHE_MAX_BYTES = 512 * 1024 * 1024
+RESULT_CACHE_MAX_AGE = 30 * 24 * 3600
+
+# request fields identifying a colocation result, user and progress_recorder do not change it
+REQUEST_KEYS = {'meanr_ave': 'Type de moyenne',
+                'tsg_product': 'Produit TSG',
+                'dataset': 'Produit SMOS',
+                'orbit_type': "Type d'orbite",
+                'transects': 'Transects',
+                'limdate_in': 'Date min',
+                'limdate_out': 'Date max',
+                'min_length': 'Longueur minimale'}
+
+
+def _normalize_value(value):
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    value = str(value).strip()
     try:
-        sqliteConnection = sqlite3.connect('database.db')
-        cursor = sqliteConnection.cursor()
-        cursor.execute('INSERT OR IGNORE INTO coloc_files (meanr_ave , tsg_product, dataset, orbit_type, transects, '
-                       'limdate_in, limdate_out, min_length) VALUES ("{}","{}", "{}","{}","{}","{}","{}",'
-                       '"{}");'.format(coloc_info['Type de moyenne'], coloc_info['Produit TSG'], coloc_info['Produit '
-                                                                                                            'SMOS'],
-                                       coloc_info["Type d'orbite"], coloc_info['Transects'], coloc_info['Date min'],
-                                       coloc_info['Date max'], coloc_info['Longueur minimale']))
-        if len(cursor) == 0:
-            path = cursor.execute('SELECT result FROM coloc_types WHERE meanr_ave = "{}" AND tsg_product = "{}" AND '
-                                  'tsg_product = "{}" AND tsg_product = "{}" AND tsg_product = "{}" AND tsg_product = '
-                                  '"{}" AND tsg_product = "{}" AND tsg_product = "{}"; '
-                                  .format(coloc_info['Type de moyenne'], coloc_info['Produit TSG'],
-                                          coloc_info['Produit SMOS'],coloc_info["Type d'orbite"],
-                                          coloc_info['Transects'], coloc_info['Date min'], coloc_info['Date max'],
-                                          coloc_info['Longueur minimale']))
-            cursor.close()
-            return path
-        else:
-            pass
-            # do the coloc
-        cursor.close()
+        number = float(value)
+    except ValueError:
+        return value
+    return int(number) if number.is_integer() else number
+
+
+def normalize_request(coloc_info):
+    """Canonical form of the colocation parameters of a request"""
+    params = {key: _normalize_value(coloc_info.get(label)) for key, label in REQUEST_KEYS.items()}
+    transects = coloc_info.get('Transects')
+    if isinstance(transects, str):
+        transects = transects.replace(',', ' ').split()
+    elif not isinstance(transects, (list, tuple, set)):
+        transects = [] if transects is None else [transects]
+    params['transects'] = sorted(set(_normalize_value(t) for t in transects), key=str)
+    return params
+
+
+def request_key(coloc_info):
+    """Content address of a colocation request: sha256 of its normalized parameters"""
+    params = json.dumps(normalize_request(coloc_info), sort_keys=True)
+    return hashlib.sha256(params.encode()).hexdigest()
+
+
+def _pack_transect(unTSG, sal3):
+    # (date, lat, lon, sal, err, std, SMOS sal) per averaged measure, little-endian float64, zlib
+    table = np.column_stack((unTSG, np.reshape(sal3, (-1, 1)))).astype('<f8')
+    return zlib.compress(table.tobytes())
+
+
+def _unpack_transect(blob):
+    table = np.frombuffer(zlib.decompress(blob), dtype='<f8').reshape(-1, 7)
+    return table[:, :6], table[:, 6]
+
+
+@metrics.timed('sqlite_query_seconds', operation='lookup_result')
+def lookup_result(key):
+    """Stored transects (itransect, transect_name, unTSG, sal3) of a request, None if not computed yet"""
+    results = None
+    try:
+        if db_access.fetchone('SELECT 1 FROM coloc_results WHERE key = ?;', (key,)) is not None:
+            rows = db_access.fetchall('SELECT itransect, name, data FROM coloc_result_transects WHERE key = ? '
+                                      'ORDER BY position;', (key,))
+            results = [(itransect, name) + _unpack_transect(data) for itransect, name, data in rows]
+            db_access.execute('UPDATE coloc_results SET last_access = ? WHERE key = ?;', (time.time(), key))
     except sqlite3.Error as error:
         print("Failed to read data from sqlite table", error)
-    finally:
-        if sqliteConnection:
-            sqliteConnection.close()
+    return results
+
+
+@metrics.timed('sqlite_query_seconds', operation='store_result')
+def store_result(key, coloc_info, results):
+    """Store the transects computed for a request"""
+    blobs = [(key, position, int(itransect), name, _pack_transect(unTSG, sal3))
+             for position, (itransect, name, unTSG, sal3) in enumerate(results)]
+    now = time.time()
+    try:
+        with db_access.transaction() as sqliteConnection:
+            sqliteConnection.execute('DELETE FROM coloc_result_transects WHERE key = ?;', (key,))
+            sqliteConnection.execute('INSERT OR REPLACE INTO coloc_results (key, params, size, created, last_access) '
+                                     'VALUES (?, ?, ?, ?, ?);',
+                                     (key, json.dumps(normalize_request(coloc_info), sort_keys=True),
+                                      sum(len(blob[-1]) for blob in blobs), now, now))
+            sqliteConnection.executemany('INSERT INTO coloc_result_transects (key, position, itransect, name, data) '
+                                         'VALUES (?, ?, ?, ?, ?);', blobs)
+    except sqlite3.Error as error:
+        print("Failed to insert data into sqlite table", error)
+
+
+@metrics.timed('sqlite_query_seconds', operation='evict_results')
+def evict_results(max_bytes=RESULT_CACHE_MAX_BYTES, max_age=RESULT_CACHE_MAX_AGE):
+    """Drop the results older than max_age seconds, then the least recently used ones above max_bytes"""
+    try:
+        with db_access.transaction(immediate=True) as sqliteConnection:
+            oldest = time.time() - max_age
+            evicted = [(row[0],) for row in sqliteConnection.execute('SELECT key FROM coloc_results '
+                                                                     'WHERE created < ?;', (oldest,))]
+            total = 0
+            for key, size in sqliteConnection.execute('SELECT key, size FROM coloc_results WHERE created >= ? '
+                                                      'ORDER BY last_access DESC;', (oldest,)).fetchall():
+                total += size
+                if total > max_bytes:
+                    evicted.append((key,))
+            sqliteConnection.executemany('DELETE FROM coloc_result_transects WHERE key = ?;', evicted)
+            sqliteConnection.executemany('DELETE FROM coloc_results WHERE key = ?;', evicted)
+    except sqlite3.Error as error:
+        print("Failed to delete data from sqlite table", error)
+
+
+def add_coloc_db(coloc_info, compute=None):
+    """Colocation result of a request, from the result cache or computed by compute(coloc_info)
+
+    Returns None on a cache miss when no compute function is given.
+    """
+    key = request_key(coloc_info)
+    results = lookup_result(key)
+    if results is not None or compute is None:
+        return results
+    results = compute(coloc_info)
+    store_result(key, coloc_info, results)
+    evict_results()
+    return results
+
+
+def run_colocation(coloc_info, progress_recorder, workers=1):
+    """Run ColocalizationProcess for a request of the colocation form, returns the colocated transects"""
+    # the colocation stack (h5py, xarray, scipy, django models) is only imported by the processes running it
+    from comp_OSIT_filt import ColocalizationProcess, Dataset, TSGTransect
+
+    params = normalize_request(coloc_info)
+    TSGProduct = TSGTransect._meta.get_field('tsg_product').related_model
+    process = ColocalizationProcess(params['meanr_ave'], TSGProduct.objects.get(pk=params['tsg_product']),
+                                    Dataset.objects.get(pk=params['dataset']), params['orbit_type'],
+                                    params['transects'], coloc_info.get('Date min'), coloc_info.get('Date max'),
+                                    coloc_info.get('utilisateur'), params['min_length'], progress_recorder, workers)
+    return process.process()
@@ -0,0 +1,45 @@
+"""Level-of-detail reduction of the time series sent to the Bokeh sessions"""
+import numpy as np
+
+# columns drawn by viz(), the others are never sent to the browser
+PLOT_COLUMNS = ['date', 'SSS_TSG', 'SSS_Argo', 'difference', 'mercatorX', 'mercatorY']
+PLOT_SERIES = ['SSS_TSG', 'SSS_Argo', 'difference']
+
+# maximum number of points sent for one view
+MAX_POINTS = 2000
+# points kept by a session source when new rows are streamed to it
+STREAM_ROLLOVER = 4 * MAX_POINTS
+
+
+def minmax_indices(x, ys, n_bins):
+    """Sorted indices of the first and last points and of the min and max of each y in n_bins equal-width x bins"""
+    x = np.asarray(x, dtype=np.float64)
+    if len(x) == 0 or x[-1] == x[0]:
+        return np.arange(len(x))
+    bins = np.minimum(((x - x[0]) * (n_bins / (x[-1] - x[0]))).astype(np.int64), n_bins - 1)
+    keep = [np.array([0, len(x) - 1])]
+    for y in ys:
+        valid = np.nonzero(~np.isnan(y))[0]
+        # sorted by bin then by value: the first and last point of each bin are its min and max
+        order = valid[np.lexsort((y[valid], bins[valid]))]
+        if len(order) == 0:
+            continue
+        b = bins[order]
+        starts = np.flatnonzero(np.concatenate(([True], b[1:] != b[:-1])))
+        ends = np.concatenate((starts[1:], [len(order)])) - 1
+        keep += [order[starts], order[ends]]
+    return np.unique(np.concatenate(keep))
+
+
+def plot_data(df, start=None, end=None, max_points=MAX_POINTS):
+    """PLOT_COLUMNS of df (sorted by date) between start and end, reduced to about max_points points"""
+    dates = df['date'].to_numpy()
+    begin = 0 if start is None else max(np.searchsorted(dates, start, side='left') - 1, 0)
+    stop = len(dates) if end is None else min(np.searchsorted(dates, end, side='right') + 1, len(dates))
+    indices = np.arange(begin, stop)
+    if stop - begin > max_points:
+        # every series contributes its min and max per bin
+        n_bins = max(max_points // (2 * len(PLOT_SERIES)), 1)
+        ys = [df[col].to_numpy()[begin:stop] for col in PLOT_SERIES]
+        indices = begin + minmax_indices(dates[begin:stop].view(np.int64), ys, n_bins)
+    return {col: df[col].to_numpy()[indices] for col in PLOT_COLUMNS}
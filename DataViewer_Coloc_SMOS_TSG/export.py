@@ -0,0 +1,205 @@
+"""Streaming export of the cleaned colocation records as Arrow IPC stream or Parquet.
+
+The records of the chosen ships are read one ship at a time from the memory-mapped columns
+of the columnar cache (coloc_cache), and encoded in record batches of BATCH_ROWS rows. Each
+batch is sent as soon as it is written, so the server holds about one batch whatever the
+number of ships and dates requested, and no concatenated DataFrame is ever built.
+
+Every batch has the same schema (export_schema): the ship, the date and the columns of the
+compact schema, difference and mercatorX/mercatorY included. pyarrow is only imported by an export.
+"""
+import os
+import time
+
+import numpy as np
+
+import metrics
+from coloc_cache import (CATEGORY_COLUMNS, COLUMNS, DROPPED_COLUMNS, INT_COLUMNS, file_signature,
+                         load_coloc_file, read_columns)
+
+# format: (mimetype, file name suffix)
+FORMATS = {'arrow': ('application/vnd.apache.arrow.stream', '.arrows'),
+           'parquet': ('application/vnd.apache.parquet', '.parquet')}
+# rows per record batch (and per Parquet row group)
+BATCH_ROWS = 65536
+
+EXPORT_COLUMNS = ['ship', 'date'] + [col for col in COLUMNS if col not in DROPPED_COLUMNS] + ['mercatorX', 'mercatorY']
+
+
+def export_schema():
+    """Arrow schema of the exported records"""
+    import pyarrow as pa
+
+    fields = [pa.field('ship', pa.dictionary(pa.int32(), pa.string())), pa.field('date', pa.timestamp('ns'))]
+    for col in EXPORT_COLUMNS[2:]:
+        if col in CATEGORY_COLUMNS:
+            fields.append(pa.field(col, pa.dictionary(pa.int8(), pa.string())))
+        elif col in INT_COLUMNS:
+            fields.append(pa.field(col, pa.from_numpy_dtype(INT_COLUMNS[col])))
+        else:
+            fields.append(pa.field(col, pa.float32()))
+    return pa.schema(fields)
+
+
+def parse_periods(values):
+    """[(start, end)] datetime64[ns] bounds (None: unbounded) of 'start/end' strings"""
+    periods = []
+    for value in values:
+        start, sep, end = value.partition('/')
+        if not sep:
+            raise ValueError('period {!r} is not start/end'.format(value))
+        periods.append(tuple(np.datetime64(v, 'ns') if v else None for v in (start, end)))
+    return periods
+
+
+def ship_columns(path, cache_dir, name):
+    """{column: array} of one ship, memory-mapped from its cache entry"""
+    filename = os.path.join(path, name)
+    entry = os.path.join(cache_dir, name)
+    signature = file_signature(filename)
+    columns = read_columns(entry, signature, mmap_mode='r')
+    if columns is not None:
+        return columns
+    # stale entry: parsed (and cached for the next exports) in memory this time
+    dfColoc = load_coloc_file(filename, cache_dir)
+    columns = {}
+    for col in dfColoc.columns:
+        if col in CATEGORY_COLUMNS and hasattr(dfColoc[col], 'cat'):
+            columns[col] = (dfColoc[col].cat.codes.to_numpy(), np.asarray(dfColoc[col].cat.categories).astype(str))
+        else:
+            columns[col] = dfColoc[col].to_numpy()
+    return columns
+
+
+def row_ranges(dates, periods):
+    """Merged [begin, stop) positions of the sorted dates within the periods"""
+    bounds = sorted((0 if start is None else int(np.searchsorted(dates, start, side='left')),
+                     len(dates) if end is None else int(np.searchsorted(dates, end, side='right')))
+                    for start, end in periods)
+    ranges = []
+    for begin, stop in bounds:
+        if stop <= begin:
+            continue
+        if ranges and begin <= ranges[-1][1]:
+            ranges[-1][1] = max(ranges[-1][1], stop)
+        else:
+            ranges.append([begin, stop])
+    return ranges
+
+
+def _array(pa, values, field):
+    """Arrow array of values (numpy, or (codes, dictionary) of a category column) with the type of field"""
+    if isinstance(values, tuple):
+        codes, dictionary = values
+        codes = np.asarray(codes, dtype=np.int8)
+        return pa.DictionaryArray.from_arrays(codes, dictionary, mask=codes < 0)
+    values = np.asarray(values)
+    if pa.types.is_integer(field.type) and values.dtype.kind == 'f':
+        # integer column stored as float32 because of missing values
+        return pa.array(values, mask=np.isnan(values)).cast(field.type)
+    return pa.array(values).cast(field.type)
+
+
+def ship_batches(pa, schema, ship_index, ship_dictionary, columns, periods, batch_rows=BATCH_ROWS):
+    """Record batches of the rows of one ship within the periods, in date order"""
+    dates = columns['date']
+    # the files are chronological, a ship that is not is read through its date order
+    order = None
+    if len(dates) > 1 and (dates[1:] < dates[:-1]).any():
+        order = np.argsort(dates, kind='stable')
+        dates = dates[order]
+    dictionaries = {col: pa.array(values[1].astype(object), type=pa.string())
+                    for col, values in columns.items() if isinstance(values, tuple)}
+    for begin, stop in row_ranges(dates, periods):
+        for start in range(begin, stop, batch_rows):
+            end = min(start + batch_rows, stop)
+            rows = slice(start, end) if order is None else order[start:end]
+            arrays = [pa.DictionaryArray.from_arrays(pa.array(np.full(end - start, ship_index, dtype=np.int32)),
+                                                     ship_dictionary)]
+            for field in list(schema)[1:]:
+                values = columns[field.name]
+                if isinstance(values, tuple):
+                    values = (values[0][rows], dictionaries[field.name])
+                else:
+                    values = values[rows]
+                arrays.append(_array(pa, values, field))
+            yield pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _ChunkSink(object):
+    """Write-only file object keeping the bytes written by a pyarrow writer until drain()"""
+
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def drain(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def stream_export(path, cache_dir, ships, periods, fmt='arrow', batch_rows=BATCH_ROWS):
+    """Generator of the encoded export of ships in the periods, one chunk per record batch.
+
+    pyarrow and the writer are set up before the generator is returned: a missing pyarrow
+    raises ImportError here, not in the middle of the response.
+    """
+    import pyarrow as pa
+
+    schema = export_schema()
+    sink = _ChunkSink()
+    if fmt == 'parquet':
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(sink, schema)
+
+        def write(batch):
+            writer.write_table(pa.Table.from_batches([batch]))
+    elif fmt == 'arrow':
+        writer = pa.ipc.new_stream(sink, schema)
+        write = writer.write_batch
+    else:
+        raise ValueError('unknown export format {!r}'.format(fmt))
+    # the same dictionary in every batch, the IPC stream sends it once
+    ship_dictionary = pa.array(ships, type=pa.string())
+
+    def chunks():
+        start = time.perf_counter()
+        nrows = 0
+        for ship_index, name in enumerate(ships):
+            columns = ship_columns(path, cache_dir, name)
+            for batch in ship_batches(pa, schema, ship_index, ship_dictionary, columns, periods, batch_rows):
+                write(batch)
+                nrows += batch.num_rows
+                # an empty chunk would end the chunked response
+                data = sink.drain()
+                if data:
+                    yield data
+        writer.close()
+        yield sink.drain()
+        metrics.inc('coloc_export_rows', nrows, format=fmt)
+        metrics.observe('coloc_export_seconds', time.perf_counter() - start, format=fmt)
+
+    return chunks()
@@ -3,106 +3,122 @@ try:
 except ImportError:
     raise RuntimeError("This example requries Python3 / asyncio")
 
-import json
-from io import StringIO
-from threading import Thread
-from db_functions import *
-import holoviews as hv
-import pandas as pd
-from bokeh.application import Application
-from bokeh.application.handlers import FunctionHandler
+from functools import partial
+from threading import Lock, Thread
+import numpy as np
+import metrics
+from coloc_cache import load_coloc_file
+from coloc_index import ColocIndex
+from dataset_registry import DatasetRegistry
+from coloc_watcher import ColocWatcher
+from db_functions import initialize_db
+from downsample import PLOT_COLUMNS, STREAM_ROLLOVER, plot_data
+from export import FORMATS as EXPORT_FORMATS, parse_periods, stream_export
+from shared_store import SharedStore
+from stats_tiles import ALL_MONTHS, LEVELS, TileStore, level_for_span
 from bokeh.embed import server_document
+from bokeh.events import RangesUpdate
 from bokeh.layouts import layout
-from bokeh.models import ColumnDataSource, LinearAxis, Range1d, CheckboxButtonGroup
+from bokeh.models import ColumnDataSource, LinearAxis, Range1d, CheckboxButtonGroup, Select, Toggle
+from bokeh.palettes import RdBu11
 from bokeh.tile_providers import CARTODBPOSITRON, get_provider
 from bokeh.plotting import figure
-from bokeh.server.server import BaseServer
-from bokeh.server.tornado import BokehTornado
-from bokeh.server.util import bind_sockets
-from flask import Flask, render_template, request, redirect, url_for
+from bokeh.transform import linear_cmap
+from flask import Flask, Response, render_template, request, redirect, url_for, jsonify
 from forms import CourseForm
-from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
-from pyproj import Transformer
+from jobs import JobQueue, get_job
 import os
 
-hv.extension('bokeh')
-
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your secret key'
 
-path = "/home/rachid/PycharmProjects/Flask_Insitude/data/"
+# application state, set up by create_app
+job_queue = None
+datasets = None
+coloc_index = None
+watcher = None
+tile_store = None
+fileNames = []
 
-files = os.listdir(path)
-files.sort()
+courses_list = []
 
-initialize_db()
+LABELS = ["Argo", "TSG", "Difference"]
 
-courses_list = []
+# Bokeh server and watcher thread of this process, started by start_services
+services = {}
+services_lock = Lock()
 
-path = "data/"
-
-# creating a dict that contain all the netcdf files
-datasets = {}
-files = os.listdir(path)
-files.sort()
-for f in files:
-    fichier = open(path + f, "r")
-    save = fichier.read()
-    fichier.close()
-    dfColoc = pd.read_csv(StringIO(save), sep="\s+")
-    dfColoc.columns = ['date_Argo', 'heure_Argo', 'lon', 'lat', 'numero_Argo', 'n_profil_Argo', 'jsp', 'profondeur',
-                       'flag', 'SSS_Argo', 'flag2', 'temp_Argo', 'flag3', 'profil1', 'profil2', 'difference', 'dist',
-                       'nbr_de_TSG', 'SSS_TSG', 'STR_SSS_TSG', 'donnee_eau', 'temp_entree', 'STR_temp_entree',
-                       'nbr_de_TSG2', 'temp_TSG', 'STR_temp_TSG']
-    dfColoc['date'] = dfColoc['date_Argo'] + ' ' + dfColoc['heure_Argo']
-    dfColoc['date'] = pd.to_datetime(dfColoc['date'], format="%Y-%m-%d %H:%M:%S")
-    dfColoc['difference'] = dfColoc['SSS_TSG'] - dfColoc['SSS_Argo']
-    dfColoc = dfColoc[dfColoc['SSS_Argo'].notna()]
-    dfColoc = dfColoc[dfColoc['SSS_TSG'].notna()]
-    trans = Transformer.from_crs(
-        "epsg:4326",
-        "epsg:3857",
-        always_xy=True,
-    )
-    xx, yy = trans.transform(dfColoc["lon"], dfColoc["lat"])
-    dfColoc['mercatorX'] = xx
-    dfColoc['mercatorY'] = yy
-    datasets[f] = dfColoc
-
-# Get a list of all file names
-fileNames = list(datasets.keys())
-
-# Innitiating containero.js
-SelectedFile = fileNames[0]
-
-# Set all the data in a dict
-optionData = {
-    'file': SelectedFile
-}
-# writing the data in the json
-json_string = json.dumps(optionData)
-with open('containero.json', 'w') as outfile:
-    outfile.write(json_string)
 
-LABELS = ["Argo", "TSG", "Difference"]
+def create_app(path="data/"):
+    """Configure the application once per process and return it.
 
+    Nothing is loaded or started here: the datasets are read on first use, and the Bokeh
+    server and the watcher start with the first request of each (gunicorn worker) process.
+    """
+    global job_queue, datasets, coloc_index, watcher, tile_store, fileNames
+    if datasets is not None:
+        return app
 
-# Bokeh app function
-def viz(doc):
-    f2 = open("containero.json")
-    selected = json.load(f2)
-    dfPlot = datasets[selected['file']].copy()
-    f2.close()
+    app.config['SECRET_KEY'] = 'your secret key'
+
+    # COLOC_PROFILING=1: a request called with ?profile=1 (or ?profile=pyinstrument) writes its profile in profiles/
+    if os.environ.get('COLOC_PROFILING') == '1':
+        metrics.profile_requests(app)
+
+    initialize_db()
+
+    # COLOC_JOB_WORKERS jobs at a time, each one colocating its transects in COLOC_COLOC_WORKERS processes
+    job_queue = JobQueue(max_workers=int(os.environ.get('COLOC_JOB_WORKERS', 2)),
+                         coloc_workers=int(os.environ.get('COLOC_COLOC_WORKERS', 1)))
+
+    # registry of the colocation files, each DataFrame is loaded from the columnar cache on first use.
+    # With COLOC_SHARED_STORE=1 the frames are views on one memory-mapped arena shared by all the workers
+    if os.environ.get('COLOC_SHARED_STORE') == '1':
+        loader = SharedStore(path).load
+    else:
+        loader = load_coloc_file
+    datasets = DatasetRegistry(path, memory_limit=int(os.environ.get('COLOC_MEMORY_LIMIT_MB', 256)) * 1024 * 1024,
+                               loader=loader)
+
+    # global index of the records of every ship, built on the first /api/colocations query.
+    # It needs dist, which the shared arena does not hold: the ships are read from the columnar cache
+    coloc_index = ColocIndex(path, loader=load_coloc_file)
+
+    # rows appended to the colocation files are ingested without restart and streamed to the sessions
+    watcher = ColocWatcher(datasets, interval=float(os.environ.get('COLOC_WATCH_INTERVAL', 10)))
+
+    # TSG - Argo statistics tiles of all ships, drawn as a heatmap under the map points
+    tile_store = TileStore(path, loader=loader)
+    # updated off the request and Bokeh threads, after every ingested append
+    watcher.subscribe(lambda name, rows: tile_store.request_refresh())
 
-    source1 = ColumnDataSource(data=dict(dfPlot))
+    # Get a list of all file names
+    fileNames = datasets.names()
 
-    p1 = figure(x_axis_type="datetime", width=800, height=800,
+    app.before_request(start_services)
+    return app
+
+
+# Bokeh app function
+@metrics.timed('bokeh_session_build_seconds')
+def viz(doc):
+    # the ship is chosen by the page embedding the session (server_document arguments)
+    arguments = doc.session_context.request.arguments if doc.session_context else {}
+    selected = arguments.get('file', [b''])[0].decode()
+    if selected not in fileNames:
+        selected = fileNames[0]
+
+    # only the plotted columns, reduced to MAX_POINTS over the visible date range
+    source1 = ColumnDataSource(data=dict.fromkeys(PLOT_COLUMNS, []))
+    map_source = ColumnDataSource(data=dict.fromkeys(PLOT_COLUMNS, []))
+    shown = {}
+
+    # explicit ranges, so that replacing source1.data does not re-fit the axis
+    p1 = figure(x_axis_type="datetime", width=800, height=800, x_range=Range1d(),
                 tools="pan,wheel_zoom,box_zoom,lasso_select,tap,reset,hover",
                 title="Salinité TSG et Argo en fonction du temps : ")
     p1.toolbar.active_drag = None
-    p1.extra_y_ranges = {
-        "différence TSG - Argo": Range1d(start=min(source1.data['difference']), end=max(source1.data['difference']))}
+    diff_range = Range1d()
+    p1.extra_y_ranges = {"différence TSG - Argo": diff_range}
     glyph5 = p1.circle('date', 'SSS_TSG', source=source1, alpha=0.5, color="green")
     glyph6 = p1.line('date', 'SSS_TSG', source=source1, color="green")
     glyph4 = p1.circle('date', 'SSS_Argo', source=source1, alpha=0.5, color="blue")
@@ -116,7 +132,65 @@ def viz(doc):
     p = figure(x_axis_type="mercator", y_axis_type="mercator", width=1000, height=800)
     p.add_tile(tile_provider)
 
-    glyph = p.circle(x='mercatorX', y='mercatorY', source=source1)
+    tile_source = ColumnDataSource(data=tile_store.layer(0))
+    heatmap = p.quad(left='x0', right='x1', bottom='y0', top='y1', source=tile_source, line_color=None,
+                     fill_color=linear_cmap('difference_mean', RdBu11, -0.5, 0.5), fill_alpha=0.6, visible=False)
+    heatmap_toggle = Toggle(label="Biais TSG - Argo (toutes campagnes)", active=False)
+    heatmap_toggle.on_change("active", lambda attr, old, new: setattr(heatmap, 'visible', new))
+
+    glyph = p.circle(x='mercatorX', y='mercatorY', source=map_source)
+    # the map fits the ship points, not the global heatmap
+    p.x_range.renderers = [glyph]
+    p.y_range.renderers = [glyph]
+
+    def update_heatmap(event):
+        # finer tiles as the map zooms in, restricted to the visible area
+        if event.x0 is None or event.x1 is None:
+            return
+        tile_source.data = tile_store.layer(level_for_span(event.x1 - event.x0), ALL_MONTHS,
+                                            event.x0, event.x1, event.y0, event.y1)
+
+    p.on_event(RangesUpdate, update_heatmap)
+
+    def show_file(name):
+        # swap the data of the existing sources, the document itself is kept
+        dfPlot = datasets[name]
+        if not dfPlot['date'].is_monotonic_increasing:
+            dfPlot = dfPlot.sort_values('date')
+        shown['name'] = name
+        shown['df'] = dfPlot
+        overview = plot_data(dfPlot)
+        source1.data = overview
+        map_source.data = dict(overview)
+        p1.x_range.update(start=dfPlot['date'].iloc[0], end=dfPlot['date'].iloc[-1])
+        diff_range.update(start=dfPlot['difference'].min(), end=dfPlot['difference'].max())
+
+    def update_detail(event):
+        # re-fetch the points of the new date range at full detail, up to MAX_POINTS
+        start = None if event.x0 is None else np.datetime64(int(event.x0), 'ms')
+        end = None if event.x1 is None else np.datetime64(int(event.x1), 'ms')
+        source1.data = plot_data(shown['df'], start, end)
+
+    p1.on_event(RangesUpdate, update_detail)
+
+    def stream_rows(rows):
+        dfPlot = datasets[shown['name']]
+        shown['df'] = dfPlot if dfPlot['date'].is_monotonic_increasing else dfPlot.sort_values('date')
+        new_data = {col: rows[col].to_numpy() for col in PLOT_COLUMNS}
+        source1.stream(new_data, rollover=STREAM_ROLLOVER)
+        map_source.stream(dict(new_data), rollover=STREAM_ROLLOVER)
+
+    def on_new_rows(name, rows):
+        # called from the watcher thread, the document is only changed from its own loop
+        if name == shown.get('name') and len(rows):
+            doc.add_next_tick_callback(partial(stream_rows, rows))
+
+    watcher.subscribe(on_new_rows)
+    doc.on_session_destroyed(lambda session_context: watcher.unsubscribe(on_new_rows))
+
+    file_select = Select(title="Navire", value=selected, options=fileNames)
+    file_select.on_change("value", lambda attr, old, new: show_file(new))
+    show_file(selected)
 
     def callback(attr, old, new):
 
@@ -143,14 +217,31 @@ def viz(doc):
     checkbox_button_group = CheckboxButtonGroup(labels=LABELS, active=[0, 1])
     checkbox_button_group.on_change("active", callback)
 
-    grid = layout([[checkbox_button_group],
+    grid = layout([[file_select, checkbox_button_group, heatmap_toggle],
                    [p1, p]])
     doc.add_root(grid)
 
 
-sockets, port = bind_sockets("localhost", 0)
+def start_services():
+    """Start the Bokeh server and the watcher of this process, once"""
+    if 'port' in services:
+        return
+    with services_lock:
+        if 'port' not in services:
+            from bokeh.server.util import bind_sockets
 
-hvapp = Application(FunctionHandler(viz))
+            sockets, port = bind_sockets("localhost", 0)
+            t = Thread(target=hv_worker, args=(sockets,))
+            t.daemon = True
+            t.start()
+            services['port'] = port
+            watcher.start()
+            tile_store.request_refresh()
+
+
+def bokeh_port():
+    start_services()
+    return services['port']
 
 
 # locally creates a page
@@ -159,25 +250,26 @@ def hv_page():
     # just set default selected values
     selected_file = fileNames[0]
 
-    # update the json after submit
     if request.method == 'POST':
         # update the file selected
         selected_file = request.form['file']
-        option_data = {
-            'file': selected_file
-        }
-        json_string = json.dumps(option_data)
-        with open('containero.json', 'w') as OUTFILE:
-            OUTFILE.write(json_string)
-
-    # script containing the app
-    script = server_document('http://localhost:%d/hvapp' % port)
+
+    # script containing the app, the selected file is a session argument of this page only
+    script = server_document('http://localhost:%d/hvapp' % bokeh_port(), arguments={'file': selected_file})
     return render_template("index.html", script=script, template="Flask",
                            files=fileNames, savedFileOpt=selected_file, select_needed=True)
 
 
-def hv_worker():
+def hv_worker(sockets):
+    from bokeh.application import Application
+    from bokeh.application.handlers import FunctionHandler
+    from bokeh.server.server import BaseServer
+    from bokeh.server.tornado import BokehTornado
+    from tornado.httpserver import HTTPServer
+    from tornado.ioloop import IOLoop
+
     asyncio.set_event_loop(asyncio.new_event_loop())
+    hvapp = Application(FunctionHandler(viz))
     bokeh_tornado = BokehTornado({'/hvapp': hvapp}, extra_websocket_origins=["127.0.0.1:8000"])
     bokeh_http = HTTPServer(bokeh_tornado)
     bokeh_http.add_sockets(sockets)
@@ -214,11 +306,102 @@ def get_form():
                       'enregistreur de progression': form.progress_recorder.data
                       }
         print(coloc_info)
-        add_coloc_db(coloc_info)
+        # the colocation runs in the background, its progress is served by /jobs/<id>
+        courses_list[-1]['job'] = job_queue.submit(coloc_info)
         return redirect(url_for('courses'))
     return render_template('formulaire.html', form=form)
 
 
+@app.route('/jobs/<int:job_id>')
+def job_status(job_id):
+    job = get_job(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
+
+@app.route('/jobs/<int:job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'unknown job'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/colocations')
+def colocations():
+    """Colocations of every ship in ?bbox=lon_min,lat_min,lon_max,lat_max&start=&end=,
+    optionally filtered by max_dist and max_abs_difference"""
+    args = request.args
+    try:
+        bbox = [float(v) for v in args['bbox'].split(',')] if 'bbox' in args else None
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError('bbox needs 4 values')
+        result = coloc_index.query(bbox=bbox, start=args.get('start'), end=args.get('end'),
+                                   max_dist=args.get('max_dist', type=float),
+                                   max_abs_difference=args.get('max_abs_difference', type=float),
+                                   limit=args.get('limit', 10000, type=int))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    result['date'] = result['date'].dt.strftime('%Y-%m-%d %H:%M:%S')
+    return jsonify({'count': len(result), 'records': result.to_dict(orient='records')})
+
+
+@app.route('/api/export')
+def export():
+    """Cleaned records of ?ships=a,b (default: every ship) in ?start=&end= or in one or more
+    ?period=start/end, streamed as ?format=arrow (IPC stream, default) or parquet"""
+    args = request.args
+    fmt = args.get('format', 'arrow')
+    if fmt not in EXPORT_FORMATS:
+        return jsonify({'error': 'format must be one of {}'.format(', '.join(EXPORT_FORMATS))}), 400
+    names = datasets.names()
+    ships = args['ships'].split(',') if 'ships' in args else names
+    unknown = [ship for ship in ships if ship not in names]
+    if unknown:
+        return jsonify({'error': 'unknown ships: {}'.format(', '.join(unknown))}), 404
+    try:
+        periods = parse_periods(args.getlist('period') or ['{}/{}'.format(args.get('start', ''), args.get('end', ''))])
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    try:
+        chunks = stream_export(datasets.path, datasets.cache_dir, ships, periods, fmt)
+    except ImportError:
+        return jsonify({'error': 'the export needs pyarrow'}), 501
+    mimetype, suffix = EXPORT_FORMATS[fmt]
+    # no Content-Length: the batches are sent with chunked transfer encoding as they are encoded
+    return Response(chunks, mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=colocations' + suffix})
+
+
+@app.route('/api/tiles/<int:level>')
+def tiles(level):
+    """Statistics tiles of one level, for ?month=YYYY-MM or all months"""
+    if not 0 <= level < len(LEVELS):
+        return jsonify({'error': 'unknown level'}), 404
+    month = request.args.get('month')
+    try:
+        month = ALL_MONTHS if month is None else int(np.datetime64(month, 'M').astype(np.int64))
+    except ValueError as error:
+        return jsonify({'error': str(error)}), 400
+    layer = tile_store.layer(level, month)
+    return jsonify({key: values.tolist() for key, values in layer.items()})
+
+
+@app.route('/metrics')
+def metrics_page():
+    """Timings and counters of this worker in the Prometheus text format"""
+    stats = datasets.stats()
+    for key in ['memory_usage', 'memory_limit', 'hits', 'misses', 'evictions']:
+        metrics.set_gauge('coloc_datasets_' + key, stats[key])
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/datasets/stats')
+def datasets_stats():
+    return jsonify(datasets.stats())
+
+
 @app.route('/propos')
 def propos():
     return render_template("propos.html")
@@ -230,9 +413,8 @@ def courses():
     return render_template('courses.html', courses_list=courses_list)
 
 
-t = Thread(target=hv_worker)
-t.daemon = True
-t.start()
+# configured at import for 'gunicorn flaskAppMultiThread:app', create_app() returns the same application
+create_app()
 
 if __name__ == '__main__':
     print('This script is intended to be run with gunicorn. e.g.')
@@ -240,6 +422,14 @@ if __name__ == '__main__':
     print('    gunicorn -w 4 flaskAppMultiThread:app')
     print()
     print('will start the app on four processes')
+    print()
+    print('    gunicorn -w 4 --preload "flaskAppMultiThread:create_app()"')
+    print()
+    print('imports the application once before forking the four processes')
+    print()
+    print('    COLOC_SHARED_STORE=1 gunicorn -w 4 flaskAppMultiThread:app')
+    print()
+    print('makes the four processes share one memory-mapped copy of the datasets')
     import sys
 
     sys.exit()
@@ -0,0 +1,221 @@
+"""Background colocation jobs, queued in database.db and run by a local process pool.
+
+A job goes through queued -> running -> done, or ends as failed or cancelled.
+Identical requests (same request_key) share the job already queued or running.
+The job table is the only shared state, so submission, dedup, progress and
+cancellation work whichever gunicorn worker handles the HTTP request.
+
+The pool processes are started by a forkserver, not forked from the gunicorn
+worker: a copy of the worker would inherit the locks its threads (Bokeh IOLoop,
+watcher, tiles, heartbeat) hold at the time of the fork, and could hang on one.
+
+The pool running a job lives in the process that submitted it (owner). This
+process refreshes the updated column of its in-flight jobs every HEARTBEAT
+seconds, so the jobs of a restarted or crashed worker stop being refreshed.
+They are marked failed once they are STALE_AFTER seconds old, and an
+identical request then queues a new job.
+"""
+import json
+import multiprocessing
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import db_access
+import metrics
+from db_functions import add_coloc_db, lookup_result, normalize_request, request_key, run_colocation
+
+QUEUED = 'queued'
+RUNNING = 'running'
+CANCELLING = 'cancelling'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+IN_FLIGHT = (QUEUED, RUNNING, CANCELLING)
+
+JOB_FIELDS = ['id', 'key', 'params', 'state', 'current', 'total', 'error', 'created', 'updated', 'owner']
+
+# seconds between two refreshes of the in-flight jobs of a process, and age of a lost job
+HEARTBEAT = 30
+STALE_AFTER = 4 * HEARTBEAT
+
+
+class JobCancelled(Exception):
+    pass
+
+
+JOB_SELECT = 'SELECT {} FROM coloc_jobs WHERE id = ?;'.format(', '.join(JOB_FIELDS))
+STALE_UPDATE = 'UPDATE coloc_jobs SET state = ?, error = ?, updated = ? WHERE state IN (?, ?, ?) AND updated < ?;'
+
+
+def _stale_params(now):
+    return (FAILED, 'lost: the process running the job stopped', now) + IN_FLIGHT + (now - STALE_AFTER,)
+
+
+def _execute(query, params=(), fetch=False):
+    rows = None
+    start = time.perf_counter()
+    try:
+        cursor = db_access.execute(query, params)
+        rows = cursor.fetchall() if fetch else cursor.rowcount
+    except sqlite3.Error as error:
+        print("Failed to access the coloc_jobs table", error)
+    finally:
+        metrics.observe('sqlite_query_seconds', time.perf_counter() - start,
+                        operation='jobs_' + query.split()[0].lower())
+    return rows
+
+
+def get_job(job_id):
+    """dict of the job row, None if it does not exist"""
+    rows = _execute(JOB_SELECT, (job_id,), fetch=True)
+    if not rows:
+        return None
+    job = dict(zip(JOB_FIELDS, rows[0]))
+    job['params'] = json.loads(job['params'])
+    return job
+
+
+def fail_stale_jobs():
+    """Mark failed the in-flight jobs whose owner process stopped refreshing them, returns their number"""
+    return _execute(STALE_UPDATE, _stale_params(time.time()))
+
+
+def _set_state(job_id, state, from_states=None, error=None):
+    """Move the job to state, only from one of from_states if given. True if the row changed"""
+    query = 'UPDATE coloc_jobs SET state = ?, error = ?, updated = ? WHERE id = ?'
+    params = [state, error, time.time(), job_id]
+    if from_states:
+        query += ' AND state IN ({})'.format(', '.join('?' * len(from_states)))
+        params += list(from_states)
+    return _execute(query + ';', params) == 1
+
+
+class JobProgressRecorder(object):
+    """progress_recorder of ColocalizationProcess writing to the job row, and the cancellation point of the job"""
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+
+    def set_progress(self, current, total):
+        _execute('UPDATE coloc_jobs SET current = ?, total = ?, updated = ? WHERE id = ?;',
+                 (current, total, time.time(), self.job_id))
+        job = get_job(self.job_id)
+        if job is not None and job['state'] == CANCELLING:
+            raise JobCancelled()
+
+
+def run_job(job_id, coloc_info, workers=1):
+    """Body of a job, executed in a process of the pool, returns the metrics it recorded.
+
+    workers processes colocate the transects of the job (ColocalizationProcess.workers).
+    """
+    import django
+    from django.apps import apps
+    from django.db import connections
+
+    if not apps.ready and os.environ.get('DJANGO_SETTINGS_MODULE'):
+        # a pool process is a fresh interpreter, not a copy of a configured gunicorn worker
+        django.setup()
+    # a pool process runs several jobs, none reuses the database connections of the previous one
+    connections.close_all()
+    db_access.close()
+    # a pool process runs several jobs, each one reports only its own metrics
+    metrics.REGISTRY.reset()
+    if not _set_state(job_id, RUNNING, from_states=[QUEUED]):
+        return metrics.REGISTRY.snapshot()  # cancelled while queued
+    progress_recorder = JobProgressRecorder(job_id)
+    try:
+        add_coloc_db(coloc_info, compute=lambda info: run_colocation(info, progress_recorder, workers))
+    except JobCancelled:
+        _set_state(job_id, CANCELLED)
+    except Exception as error:
+        _set_state(job_id, FAILED, error=repr(error))
+        raise
+    else:
+        _set_state(job_id, DONE, from_states=[RUNNING])
+    return metrics.REGISTRY.snapshot()
+
+
+class JobQueue(object):
+    """Submission and control of the colocation jobs of this process"""
+
+    def __init__(self, max_workers=2, coloc_workers=1):
+        self.max_workers = max_workers  # jobs run at the same time
+        self.coloc_workers = coloc_workers  # processes colocating the transects of one job
+        self._executor = None
+        self._futures = {}
+        self._heartbeat = None
+        self._stopped = threading.Event()
+        # jobs left in flight by a previous worker
+        fail_stale_jobs()
+
+    def submit(self, coloc_info):
+        """id of the job computing coloc_info, reusing an identical in-flight or cached request"""
+        key = request_key(coloc_info)
+        start = time.perf_counter()
+        try:
+            # check and insert in one write transaction, so two workers cannot queue the same request
+            with db_access.transaction(immediate=True) as sqliteConnection:
+                now = time.time()
+                # a lost job must not be shared with the new request
+                sqliteConnection.execute(STALE_UPDATE, _stale_params(now))
+                row = sqliteConnection.execute('SELECT id FROM coloc_jobs WHERE key = ? AND state IN (?, ?, ?) '
+                                               'ORDER BY id LIMIT 1;', (key,) + IN_FLIGHT).fetchone()
+                if row is not None:
+                    return row[0]
+                job_id = sqliteConnection.execute(
+                    'INSERT INTO coloc_jobs (key, params, state, current, total, created, updated, owner) '
+                    'VALUES (?, ?, ?, 0, 0, ?, ?, ?);',
+                    (key, json.dumps(normalize_request(coloc_info), sort_keys=True), QUEUED, now, now,
+                     os.getpid())).lastrowid
+        finally:
+            metrics.observe('sqlite_query_seconds', time.perf_counter() - start, operation='jobs_submit')
+
+        if lookup_result(key) is not None:
+            _set_state(job_id, DONE, from_states=[QUEUED])
+            return job_id
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                 mp_context=multiprocessing.get_context('forkserver'))
+        if self._heartbeat is None:
+            # started in the process owning the pool (after the gunicorn fork)
+            self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+            self._heartbeat.start()
+        future = self._executor.submit(run_job, job_id, coloc_info, self.coloc_workers)
+        future.add_done_callback(lambda f: self._done(job_id, f))
+        self._futures[job_id] = future
+        return job_id
+
+    def _beat(self):
+        while not self._stopped.wait(HEARTBEAT):
+            if self._futures:
+                _execute('UPDATE coloc_jobs SET updated = ? WHERE owner = ? AND state IN (?, ?, ?);',
+                         (time.time(), os.getpid()) + IN_FLIGHT)
+
+    def _done(self, job_id, future):
+        self._futures.pop(job_id, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            # e.g. a crashed pool process, run_job could not record it
+            _set_state(job_id, FAILED, from_states=IN_FLIGHT, error=repr(future.exception()))
+        elif future.result() is not None:
+            metrics.REGISTRY.merge(future.result())
+
+    def cancel(self, job_id):
+        """Cancel a queued job at once, ask a running one to stop at its next progress update"""
+        future = self._futures.get(job_id)
+        if future is not None and future.cancel():
+            _set_state(job_id, CANCELLED, from_states=[QUEUED])
+        elif not _set_state(job_id, CANCELLED, from_states=[QUEUED]):
+            _set_state(job_id, CANCELLING, from_states=[RUNNING])
+        return get_job(job_id)
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,201 @@
+"""Lightweight timing instrumentation of the hot paths, rendered in the Prometheus text format.
+
+Counters, gauges and latency histograms live in one registry per process: every gunicorn
+worker serves its own values on /metrics. The colocation jobs run in pool processes, they
+send their metrics back to the web process with their result (see jobs.run_job).
+
+    with metrics.span('coloc_process_stage_seconds', stage='load_smos'):
+        ...
+
+    @metrics.timed('sqlite_query_seconds', operation='lookup_result')
+    def lookup_result(key):
+        ...
+"""
+import functools
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# upper bounds (seconds) of the latency histograms
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+HELP = {
+    'coloc_process_stage_seconds': 'Duration of the stages of ColocalizationProcess.process',
+    'coloc_file_load_seconds': 'Load time of a colocation file, from the columnar cache or parsed',
+    'coloc_file_last_load_seconds': 'Duration of the last load of each colocation file',
+    'coloc_file_size_bytes': 'Size of each colocation file on disk',
+    'coloc_file_rows': 'Rows of each loaded colocation file',
+    'bokeh_session_build_seconds': 'Construction of the Bokeh document of a viewer session',
+    'sqlite_query_seconds': 'Latency of the database.db accesses',
+    'coloc_export_rows': 'Records streamed by /api/export',
+    'coloc_export_seconds': 'Duration of the /api/export responses, streaming included',
+}
+
+
+class Registry(object):
+    """Counters, gauges and histograms, each keyed by name and sorted label pairs"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                # per-bucket counts (the last one is +Inf), count and sum
+                histogram = self.histograms[key] = [[0] * (len(BUCKETS) + 1), 0, 0.0]
+            i = 0
+            while i < len(BUCKETS) and value > BUCKETS[i]:
+                i += 1
+            histogram[0][i] += 1
+            histogram[1] += 1
+            histogram[2] += value
+
+    def snapshot(self):
+        """Picklable copy of the registry, for merge() in another process"""
+        with self._lock:
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'histograms': {key: [list(h[0]), h[1], h[2]] for key, h in self.histograms.items()}}
+
+    def merge(self, snapshot):
+        """Add the counters and histograms of a snapshot, take its gauges"""
+        with self._lock:
+            for key, value in snapshot['counters'].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            self.gauges.update(snapshot['gauges'])
+            for key, (buckets, count, total) in snapshot['histograms'].items():
+                histogram = self.histograms.setdefault(key, [[0] * (len(BUCKETS) + 1), 0, 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], buckets)]
+                histogram[1] += count
+                histogram[2] += total
+
+    def render(self):
+        """Text exposition format of every metric"""
+        with self._lock:
+            families = {}
+            for kind, metrics in (('counter', self.counters), ('gauge', self.gauges),
+                                  ('histogram', self.histograms)):
+                for (name, labels), value in metrics.items():
+                    families.setdefault((name, kind), []).append((labels, value))
+
+        lines = []
+        for (name, kind), samples in sorted(families.items()):
+            if name in HELP:
+                lines.append('# HELP {} {}'.format(name, HELP[name]))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in sorted(samples):
+                if kind != 'histogram':
+                    lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                    continue
+                buckets, count, total = value
+                cumulated = 0
+                for bound, n in zip(BUCKETS + ('+Inf',), buckets):
+                    cumulated += n
+                    lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', str(bound)),)), cumulated))
+                lines.append('{}_sum{} {}'.format(name, _labels(labels), _number(total)))
+                lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join('{}="{}"'.format(key, value) for (key, _), value in zip(labels, escaped)) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = Registry()
+
+inc = REGISTRY.inc
+set_gauge = REGISTRY.set
+observe = REGISTRY.observe
+render = REGISTRY.render
+
+
+@contextmanager
+def span(name, **labels):
+    """Observe the duration of the with block in the histogram name, exceptions included"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - start, **labels)
+
+
+def timed(name, **labels):
+    """Decorator observing the duration of every call"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profile_requests(app, directory='profiles'):
+    """Profile the Flask requests called with ?profile=1 (cProfile, .prof) or ?profile=pyinstrument (.html).
+
+    The profiles are written to directory, one file per request.
+    """
+    from flask import g, request
+
+    @app.before_request
+    def start_profile():
+        mode = request.args.get('profile')
+        if mode not in ('1', 'pyinstrument'):
+            return
+        if mode == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                print('pyinstrument is not installed, using cProfile')
+                mode = '1'
+            else:
+                g.profiler = ('pyinstrument', Profiler())
+                g.profiler[1].start()
+                return
+        import cProfile
+        g.profiler = ('cProfile', cProfile.Profile())
+        g.profiler[1].enable()
+
+    @app.after_request
+    def stop_profile(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        os.makedirs(directory, exist_ok=True)
+        name = os.path.join(directory, '{}-{}-{}'.format(request.endpoint, time.strftime('%Y%m%d-%H%M%S'),
+                                                         os.getpid()))
+        kind, profile = profiler
+        if kind == 'pyinstrument':
+            profile.stop()
+            with open(name + '.html', 'w') as outfile:
+                outfile.write(profile.output_html())
+        else:
+            profile.disable()
+            profile.dump_stats(name + '.prof')
+        print('request profile written to {}'.format(name))
+        return response
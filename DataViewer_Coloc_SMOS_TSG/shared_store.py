@@ -0,0 +1,215 @@
+"""Memory-mapped arena holding the plotted columns of every ship, shared by the gunicorn workers.
+
+The arena is built from the columnar cache into cache/arena.bin, described by
+cache/arena.json. Each ship is one segment of the file, its columns one after
+another with the dtypes of the compact schema (float32, int64 nanosecond dates).
+Every worker maps the same file read-only, so the pages live once in the OS
+page cache whatever the number of workers.
+
+Build it ahead of time with:
+
+    python shared_store.py [data_dir] [--cache-dir cache/]
+
+otherwise the first worker that needs it builds it while the others wait. A
+SharedStore maps the arena on its first use, not when it is created. When the
+file of a ship changes, only that ship gets a new segment at the end of the
+arena; the arena is written again in full once the replaced segments take more
+room than the live ones.
+"""
+import argparse
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import metrics
+from coloc_cache import CACHE_DIR, DATA_DIR, file_signature, list_coloc_files, load_coloc_file
+
+ARENA_VERSION = 2
+ARENA_COLUMNS = ['date', 'lon', 'lat', 'SSS_Argo', 'SSS_TSG', 'difference', 'mercatorX', 'mercatorY']
+# dtypes of the compact schema, the columns are mapped as they are stored
+ARENA_DTYPES = {col: np.dtype('datetime64[ns]') if col == 'date' else np.dtype(np.float32) for col in ARENA_COLUMNS}
+
+
+def _paths(cache_dir):
+    return (os.path.join(cache_dir, 'arena.bin'), os.path.join(cache_dir, 'arena.json'),
+            os.path.join(cache_dir, 'arena.lock'))
+
+
+def _read_layout(cache_dir):
+    try:
+        with open(_paths(cache_dir)[1]) as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_layout(cache_dir, layout):
+    json_path = _paths(cache_dir)[1]
+    with open(json_path + '.tmp', 'w') as outfile:
+        json.dump(layout, outfile)
+    os.replace(json_path + '.tmp', json_path)
+
+
+def _column_offsets(nrows):
+    """Offsets of the columns in the segment of a ship of nrows rows (each one on 8 bytes), and its size"""
+    offsets = []
+    size = 0
+    for col in ARENA_COLUMNS:
+        offsets.append(size)
+        nbytes = nrows * ARENA_DTYPES[col].itemsize
+        size += nbytes + -nbytes % 8
+    return offsets, size
+
+
+def _segment(df):
+    """Bytes of the segment of one ship"""
+    parts = []
+    for col in ARENA_COLUMNS:
+        data = np.ascontiguousarray(df[col].to_numpy(dtype=ARENA_DTYPES[col])).tobytes()
+        parts.append(data + b'\0' * (-len(data) % 8))
+    return b''.join(parts)
+
+
+def _append_ship(outfile, layout, path, cache_dir, name, signature):
+    """Write the segment of name at the end of the arena and point the layout at it"""
+    df = load_coloc_file(os.path.join(path, name), cache_dir)
+    data = _segment(df)
+    old = layout['ships'].get(name)
+    if old is not None:
+        layout['garbage'] += old['bytes']
+    outfile.seek(layout['size'])
+    outfile.write(data)
+    layout['ships'][name] = {'offset': layout['size'], 'nrows': len(df), 'bytes': len(data),
+                             'signature': signature}
+    layout['size'] += len(data)
+
+
+def build_arena(path=DATA_DIR, cache_dir=CACHE_DIR):
+    """Write the segments of every ship into a new arena file"""
+    bin_path, _, _ = _paths(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    layout = {'version': ARENA_VERSION, 'columns': ARENA_COLUMNS, 'size': 0, 'garbage': 0, 'ships': {}}
+    # the workers keep their mapping of the replaced file until they map the new one
+    fd, tmp = tempfile.mkstemp(prefix='arena.bin.tmp-', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as outfile:
+        for name in list_coloc_files(path):
+            _append_ship(outfile, layout, path, cache_dir, name, file_signature(os.path.join(path, name)))
+    os.replace(tmp, bin_path)
+    _write_layout(cache_dir, layout)
+    print('arena built: {} ships, {} rows'.format(len(layout['ships']),
+                                                 sum(ship['nrows'] for ship in layout['ships'].values())))
+    return layout
+
+
+def update_arena(path=DATA_DIR, cache_dir=CACHE_DIR, names=None):
+    """Bring the ships of names (default: every ship) up to date in the arena, returns its layout.
+
+    The caller holds cache/arena.lock.
+    """
+    bin_path, _, _ = _paths(cache_dir)
+    layout = _read_layout(cache_dir)
+    if layout is None or layout['version'] != ARENA_VERSION or not os.path.exists(bin_path):
+        return build_arena(path, cache_dir)
+    files = list_coloc_files(path)
+    changed = False
+    for name in [name for name in layout['ships'] if name not in files]:
+        layout['garbage'] += layout['ships'].pop(name)['bytes']
+        changed = True
+    stale = []
+    for name in (files if names is None else [name for name in names if name in files]):
+        signature = file_signature(os.path.join(path, name))
+        ship = layout['ships'].get(name)
+        if ship is None or ship['signature'] != signature:
+            stale.append((name, signature))
+    if not stale and not changed:
+        return layout
+    replaced = sum(layout['ships'][name]['bytes'] for name, _ in stale if name in layout['ships'])
+    if 2 * (layout['garbage'] + replaced) > layout['size']:
+        return build_arena(path, cache_dir)
+    with open(bin_path, 'r+b') as outfile:
+        for name, signature in stale:
+            _append_ship(outfile, layout, path, cache_dir, name, signature)
+    _write_layout(cache_dir, layout)
+    return layout
+
+
+class SharedStore(object):
+    """Zero-copy, read-only view of the arena"""
+
+    def __init__(self, path=DATA_DIR, cache_dir=CACHE_DIR):
+        self.path = path
+        self.cache_dir = cache_dir
+        # (layout, mapped bytes), replaced together
+        self._mapping = (None, None)
+
+    @property
+    def layout(self):
+        return self._mapping[0]
+
+    def attach(self, names=None):
+        """Map the arena, after bringing the ships of names (default: every ship) up to date"""
+        bin_path, _, lock_path = _paths(self.cache_dir)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(lock_path, 'w') as lock:
+            # one writer at a time, the other workers wait and then map its result
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                layout = update_arena(self.path, self.cache_dir, names)
+                arena = np.empty(0, dtype=np.uint8)
+                if layout['size']:
+                    arena = np.memmap(bin_path, dtype=np.uint8, mode='r', shape=(layout['size'],))
+                self._mapping = (layout, arena)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _attached(self):
+        if self.layout is None:
+            self.attach()
+        return self._mapping
+
+    def names(self):
+        return list(self._attached()[0]['ships'])
+
+    def columns(self, name):
+        """dict column -> read-only array view of one ship"""
+        layout, arena = self._attached()
+        ship = layout['ships'][name]
+        offsets, _ = _column_offsets(ship['nrows'])
+        data = {}
+        for col, offset in zip(ARENA_COLUMNS, offsets):
+            start = ship['offset'] + offset
+            data[col] = arena[start:start + ship['nrows'] * ARENA_DTYPES[col].itemsize].view(ARENA_DTYPES[col])
+        return data
+
+    def load(self, filename, cache_dir=None):
+        """DataFrame backed by the arena, usable as a DatasetRegistry loader"""
+        name = os.path.basename(filename)
+        start = time.perf_counter()
+        ship = self.layout['ships'].get(name) if self.layout is not None else None
+        if ship is None or ship['signature'] != file_signature(filename):
+            # a new segment for this ship only, the others are not read again
+            self.attach([name])
+        # copy=False keeps one block per column pointing into the mapping
+        df = pd.DataFrame(self.columns(name), copy=False)
+        elapsed = time.perf_counter() - start
+        metrics.observe('coloc_file_load_seconds', elapsed, source='arena')
+        metrics.set_gauge('coloc_file_last_load_seconds', elapsed, file=name)
+        metrics.set_gauge('coloc_file_rows', len(df), file=name)
+        return df
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the shared memory-mapped arena of the colocation files')
+    parser.add_argument('data_dir', nargs='?', default=DATA_DIR)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+    build_arena(args.data_dir, args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""Readers of the SMOS SSS datasets (1440 lon x 720 lat x N days) used by the colocation.
+
+MATLAB v7.3 files are HDF5: their SSS cube is read through h5py one day at a
+time, and only over the lon/lat band covering the requested points. Older
+.mat files cannot be read partially and are loaded whole, as before.
+
+Convert an old .mat file to a chunked v7.3-compatible file with:
+
+    python smos_reader.py dataset.mat dataset_v73.mat
+"""
+import argparse
+
+import h5py
+import numpy as np
+from scipy.io import loadmat
+
+
+class SMOSCube(object):
+    """SSS cube held in memory, indexed like the (lon, lat, day) array of the .mat file"""
+
+    def __init__(self, SSS):
+        self.SSS = SSS
+        self.SSS[self.SSS == 0] = np.nan
+        self.shape = SSS.shape
+
+    def __getitem__(self, key):
+        return self.SSS[key]
+
+    def reopen(self):
+        return self
+
+    def close(self):
+        pass
+
+
+class HDF5SMOSCube(object):
+    """SSS cube of a MATLAB v7.3 file, read lazily.
+
+    MATLAB stores the arrays transposed, the HDF5 dataset is (day, lat, lon).
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.h5file = h5py.File(filename, 'r')
+        self.dataset = self.h5file['SSS']
+        nday, nlat, nlon = self.dataset.shape
+        self.shape = (nlon, nlat, nday)
+
+    def __getitem__(self, key):
+        """Point-wise gather: key is a tuple of broadcastable (lon, lat, day) index arrays"""
+        ilon, ilat, iday = np.broadcast_arrays(*key)
+        values = np.empty(ilon.shape, dtype=self.dataset.dtype)
+        values[:] = np.nan
+        flon, flat, fday, fvalues = ilon.ravel(), ilat.ravel(), iday.ravel(), values.reshape(-1)
+        for day in np.unique(fday):
+            sel = np.nonzero(fday == day)[0]
+            lat0, lat1 = flat[sel].min(), flat[sel].max() + 1
+            lon0, lon1 = flon[sel].min(), flon[sel].max() + 1
+            # one hyperslab per day, bounded by the points of that day
+            block = self.dataset[day, lat0:lat1, lon0:lon1]
+            fvalues[sel] = block[flat[sel] - lat0, flon[sel] - lon0]
+        values[values == 0] = np.nan
+        return values
+
+    def reopen(self):
+        """New handle on the same file, for a forked worker"""
+        return HDF5SMOSCube(self.filename)
+
+    def close(self):
+        self.h5file.close()
+
+
+def open_smos_dataset(filename):
+    """(ttdayJulian, SSS cube) of a SMOS dataset file"""
+    if h5py.is_hdf5(filename):
+        cube = HDF5SMOSCube(filename)
+        return np.squeeze(np.array(cube.h5file['ttdayJulian'])), cube
+    mat = loadmat(filename)
+    return np.squeeze(mat['ttdayJulian']), SMOSCube(mat['SSS'])
+
+
+def convert_to_hdf5(filename, output):
+    """Write SSS and ttdayJulian of an old .mat file in the v7.3 layout, chunked by day and band"""
+    mat = loadmat(filename)
+    with h5py.File(output, 'w') as h5file:
+        h5file.create_dataset('SSS', data=np.transpose(mat['SSS'], (2, 1, 0)), chunks=(1, 90, 180))
+        h5file.create_dataset('ttdayJulian', data=np.atleast_2d(np.squeeze(mat['ttdayJulian'])))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert a SMOS dataset to a chunked HDF5 (MATLAB v7.3) file')
+    parser.add_argument('input')
+    parser.add_argument('output')
+    args = parser.parse_args()
+    convert_to_hdf5(args.input, args.output)
+
+
+if __name__ == '__main__':
+    main()
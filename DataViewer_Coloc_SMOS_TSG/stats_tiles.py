@@ -0,0 +1,221 @@
+"""Pre-aggregated statistics tiles of difference, SSS_TSG and SSS_Argo over all ships.
+
+Tiles are lon/lat cells at several resolutions (LEVELS, in degrees), for every
+month plus an all-months aggregate (month == ALL_MONTHS). Each tile holds the
+count and the mean, std and median of the variables, and its bounds projected
+to web mercator like mercatorX/mercatorY.
+
+Every ship keeps a partial (cell inputs of its records) in cache/tiles/ships/,
+rebuilt only when its file changes; the level files cache/tiles/level_<i>.npz
+are re-merged from the partials when one of them changed. In the app, TileStore
+updates them in a background thread, the sessions only read the level files.
+
+Prebuild them with:
+
+    python stats_tiles.py [data_dir] [--cache-dir cache/]
+"""
+import argparse
+import fcntl
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from coloc_cache import CACHE_DIR, DATA_DIR, file_signature, list_coloc_files, load_coloc_file, mercator_transformer
+
+LEVELS = [4.0, 1.0, 0.25]
+VARIABLES = ['difference', 'SSS_TSG', 'SSS_Argo']
+ALL_MONTHS = -1
+# web mercator is undefined at the poles
+MERCATOR_MAX_LAT = 85.05
+# columns of the level files
+TILE_COLUMNS = (['row', 'col', 'month', 'count'] +
+                [var + stat for var in VARIABLES for stat in ('_mean', '_std', '_median')] + ['x0', 'y0', 'x1', 'y1'])
+# seconds between two checks of the data files by the background refresh, without request
+REFRESH_INTERVAL = 300.0
+
+
+def _tiles_dir(cache_dir):
+    return os.path.join(cache_dir, 'tiles')
+
+
+def ship_partial(df):
+    """Inputs of the tiles for one ship: lon, lat, month (since 1970-01) and the variables"""
+    partial = {'lon': df['lon'].to_numpy(dtype=np.float64),
+               'lat': df['lat'].to_numpy(dtype=np.float64),
+               'month': df['date'].to_numpy().astype('datetime64[M]').astype(np.int64)}
+    for var in VARIABLES:
+        partial[var] = df[var].to_numpy(dtype=np.float64)
+    return partial
+
+
+def _stats(frame, keys):
+    grouped = frame.groupby(keys)
+    stats = {'count': grouped.size()}
+    for var in VARIABLES:
+        stats[var + '_mean'] = grouped[var].mean()
+        stats[var + '_std'] = grouped[var].std(ddof=0)
+        stats[var + '_median'] = grouped[var].median()
+    return pd.DataFrame(stats).reset_index()
+
+
+def aggregate(partial, cell):
+    """Tiles of one level from the concatenated partials"""
+    row = np.clip(np.floor((partial['lat'] + 90) / cell), 0, round(180 / cell) - 1).astype(np.int64)
+    col = np.clip(np.floor(np.mod(partial['lon'] + 180, 360) / cell), 0, round(360 / cell) - 1).astype(np.int64)
+    frame = pd.DataFrame(dict({'row': row, 'col': col, 'month': partial['month']},
+                              **{var: partial[var] for var in VARIABLES}))
+    overall = _stats(frame, ['row', 'col'])
+    overall.insert(2, 'month', ALL_MONTHS)
+    tiles = pd.concat([_stats(frame, ['row', 'col', 'month']), overall], ignore_index=True)
+
+    trans = mercator_transformer()
+    lat0 = np.clip(tiles['row'] * cell - 90, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT)
+    lat1 = np.clip((tiles['row'] + 1) * cell - 90, -MERCATOR_MAX_LAT, MERCATOR_MAX_LAT)
+    tiles['x0'], tiles['y0'] = trans.transform(tiles['col'] * cell - 180, lat0)
+    tiles['x1'], tiles['y1'] = trans.transform((tiles['col'] + 1) * cell - 180, lat1)
+    return tiles
+
+
+def update_tiles(path=DATA_DIR, cache_dir=CACHE_DIR, loader=load_coloc_file):
+    """Rebuild the partials of the changed ships, then the level files if any partial changed"""
+    os.makedirs(_tiles_dir(cache_dir), exist_ok=True)
+    with open(os.path.join(_tiles_dir(cache_dir), 'tiles.lock'), 'w') as lock:
+        # one gunicorn worker updates the tiles, the others wait and find them up to date
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return _update_tiles(path, cache_dir, loader)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _update_tiles(path, cache_dir, loader):
+    ships_dir = os.path.join(_tiles_dir(cache_dir), 'ships')
+    manifest_path = os.path.join(_tiles_dir(cache_dir), 'manifest.json')
+    os.makedirs(ships_dir, exist_ok=True)
+    try:
+        with open(manifest_path) as infile:
+            manifest = json.load(infile)
+    except (OSError, ValueError):
+        manifest = {}
+
+    signatures = {f: file_signature(os.path.join(path, f)) for f in list_coloc_files(path)}
+    changed = [f for f in signatures if manifest.get(f) != signatures[f]]
+    removed = [f for f in manifest if f not in signatures]
+    if not changed and not removed and all(os.path.exists(_level_path(cache_dir, i)) for i in range(len(LEVELS))):
+        return False
+
+    for f in changed:
+        partial = ship_partial(loader(os.path.join(path, f), cache_dir))
+        np.savez(os.path.join(ships_dir, f + '.npz'), **partial)
+    for f in removed:
+        if os.path.exists(os.path.join(ships_dir, f + '.npz')):
+            os.remove(os.path.join(ships_dir, f + '.npz'))
+
+    partials = []
+    for f in signatures:
+        with np.load(os.path.join(ships_dir, f + '.npz')) as partial:
+            partials.append({key: partial[key] for key in partial.files})
+    merged = {key: np.concatenate([p[key] for p in partials]) if partials else np.empty(0)
+              for key in ['lon', 'lat', 'month'] + VARIABLES}
+    for i, cell in enumerate(LEVELS):
+        tiles = aggregate(merged, cell)
+        tmp = _level_path(cache_dir, i) + '.tmp.npz'
+        np.savez(tmp, **{col: tiles[col].to_numpy() for col in tiles.columns})
+        os.replace(tmp, _level_path(cache_dir, i))
+
+    with open(manifest_path + '.tmp', 'w') as outfile:
+        json.dump(signatures, outfile)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    print('statistics tiles updated: {} ships changed, {} removed'.format(len(changed), len(removed)))
+    return True
+
+
+def _level_path(cache_dir, level):
+    return os.path.join(_tiles_dir(cache_dir), 'level_{}.npz'.format(level))
+
+
+class TileStore(object):
+    """Tiles of every level, loaded once per process and reloaded when their file is rewritten.
+
+    The level files are updated by refresh(), or by a background thread with request_refresh():
+    reading the tiles never waits for an update.
+    """
+
+    def __init__(self, path=DATA_DIR, cache_dir=CACHE_DIR, loader=load_coloc_file, interval=REFRESH_INTERVAL):
+        self.path = path
+        self.cache_dir = cache_dir
+        self.loader = loader
+        self.interval = interval
+        self._levels = {}
+        self._lock = threading.Lock()
+        self._requested = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def refresh(self):
+        with self._lock:
+            update_tiles(self.path, self.cache_dir, self.loader)
+
+    def request_refresh(self):
+        """Update the tiles in the background thread, the requests made meanwhile are merged"""
+        self._requested.set()
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            # also checks the files from time to time, for the rewritten or added ones
+            self._requested.wait(self.interval)
+            self._requested.clear()
+            try:
+                self.refresh()
+            except Exception as error:
+                print('statistics tiles error:', repr(error))
+
+    def tiles(self, level):
+        """Columns of the tiles of one level, empty until the level file is first built"""
+        filename = _level_path(self.cache_dir, level)
+        if not os.path.exists(filename):
+            self.request_refresh()
+            return {col: np.empty(0) for col in TILE_COLUMNS}
+        mtime = os.stat(filename).st_mtime_ns
+        cached = self._levels.get(level)
+        if cached is None or cached[0] != mtime:
+            with np.load(filename) as data:
+                cached = (mtime, {key: data[key] for key in data.files})
+            self._levels[level] = cached
+        return cached[1]
+
+    def layer(self, level, month=ALL_MONTHS, x0=None, x1=None, y0=None, y1=None):
+        """Columns of the tiles of one level and month, restricted to a mercator view if given"""
+        tiles = self.tiles(level)
+        mask = tiles['month'] == month
+        if x0 is not None:
+            mask &= (tiles['x1'] >= x0) & (tiles['x0'] <= x1) & (tiles['y1'] >= y0) & (tiles['y0'] <= y1)
+        return {key: values[mask] for key, values in tiles.items()}
+
+
+def level_for_span(span):
+    """Tile level fitting a map view span (mercator meters)"""
+    if span > 8e6:
+        return 0
+    if span > 1.5e6:
+        return 1
+    return 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the statistics tiles of the colocation files')
+    parser.add_argument('data_dir', nargs='?', default=DATA_DIR)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+    update_tiles(args.data_dir, args.cache_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""Indexed storage of the TSG transect files (transectTSG: transect x measure x [date, lat, lon, sal, err]).
+
+The transects of the .mat/.nc files are padded with NaN to the longest one. The store keeps
+only the valid measures of each transect, back to back, in a directory next to the file:
+
+    <transect file>.store/samples.npy   float64 (total measures, 5), memory-mapped
+    <transect file>.store/index.npy     one row per transect: offset, length, first/last and min/max dates
+    <transect file>.store/meta.json     version and signature (mtime, size) of the transect file
+
+so a colocation reads only the measures of its transects, and the date filter only reads
+the index. Build the store of a transect file with:
+
+    python transect_store.py LSAT-DATA/transects/<file>.mat
+"""
+import argparse
+import json
+import os
+import shutil
+
+import h5py
+import numpy as np
+import xarray as xr
+
+from coloc_cache import file_signature
+
+STORE_VERSION = 1
+INDEX_DTYPE = np.dtype([('offset', np.int64), ('length', np.int64), ('first', np.float64), ('last', np.float64),
+                        ('date_min', np.float64), ('date_max', np.float64)])
+# transects read at a time by the conversion
+BLOCK = 64
+
+
+def read_transect_file(filename):
+    """Whole transectTSG array of a .mat (v7.3, h5py) or .nc (xarray) transect file"""
+    if filename.endswith('.mat'):
+        with h5py.File(filename, 'r') as tf:
+            return np.array(tf['transectTSG']).T
+    if filename.endswith('.nc'):
+        ds = xr.open_dataset(filename)
+        transectTSG = ds['transectTSG'].values
+        ds.close()
+        return transectTSG
+    raise ValueError('*** Unknown transect file format! {}'.format(filename))
+
+
+def _blocks(filename, block=BLOCK):
+    """(first transect, array (k, measure, 5)) of consecutive transects, without reading the whole file"""
+    if filename.endswith('.mat'):
+        with h5py.File(filename, 'r') as tf:
+            dataset = tf['transectTSG']  # stored transposed by MATLAB: (5, measure, transect)
+            for start in range(0, dataset.shape[-1], block):
+                yield start, np.array(dataset[:, :, start:start + block]).T
+    elif filename.endswith('.nc'):
+        with xr.open_dataset(filename) as ds:
+            variable = ds['transectTSG']
+            for start in range(0, variable.shape[0], block):
+                yield start, variable[start:start + block].values
+    else:
+        raise ValueError('*** Unknown transect file format! {}'.format(filename))
+
+
+def index_rows(transects):
+    """Index rows (without offset) of an array of transects (k, measure, 5)"""
+    dates = transects[:, :, 0]
+    nonan = ~np.isnan(dates)
+    rows = np.zeros(len(transects), dtype=INDEX_DTYPE)
+    # colocate_transect takes as many leading measures as there are valid dates
+    rows['length'] = nonan.sum(axis=1)
+    first = np.argmax(nonan, axis=1)
+    last = dates.shape[1] - 1 - np.argmax(nonan[:, ::-1], axis=1)
+    empty = rows['length'] == 0
+    rows['first'] = np.where(empty, np.nan, dates[np.arange(len(dates)), first])
+    rows['last'] = np.where(empty, np.nan, dates[np.arange(len(dates)), last])
+    filled = np.where(nonan, dates, np.inf)
+    rows['date_min'] = np.where(empty, np.nan, filled.min(axis=1))
+    filled = np.where(nonan, dates, -np.inf)
+    rows['date_max'] = np.where(empty, np.nan, filled.max(axis=1))
+    return rows
+
+
+def _set_offsets(index):
+    index['offset'] = np.cumsum(index['length']) - index['length']
+
+
+class TransectStore(object):
+    """Valid measures of every transect and their index, memory-mapped or in memory"""
+
+    def __init__(self, index, data):
+        self.index = index
+        self.data = data
+
+    @classmethod
+    def from_array(cls, transectTSG):
+        """Store of a whole transectTSG array, for the transect files without a converted store"""
+        index = index_rows(transectTSG)
+        _set_offsets(index)
+        samples = np.concatenate([transectTSG[i, :length] for i, length in enumerate(index['length'])]) \
+            if len(index) else np.empty((0, 5))
+        return cls(index, samples)
+
+    def __len__(self):
+        return len(self.index)
+
+    def select(self, transects, date_in=None, date_out=None):
+        """transects (in their order) whose dates overlap [date_in, date_out] (datenums, None: unbounded)"""
+        rows = self.index[np.asarray(transects, dtype=int)]
+        keep = np.ones(len(rows), dtype=bool)
+        if date_in is not None:
+            keep &= rows['date_max'] >= date_in
+        if date_out is not None:
+            keep &= rows['date_min'] <= date_out
+        return [itransect for itransect, kept in zip(transects, keep) if kept]
+
+    def samples(self, itransect):
+        """(length, 5) valid measures of one transect, read into memory"""
+        row = self.index[itransect]
+        return np.array(self.data[row['offset']:row['offset'] + row['length']])
+
+    def date_bounds(self, transects):
+        """first and last valid dates (datenums) of transects"""
+        rows = self.index[np.asarray(transects, dtype=int)]
+        return rows['first'], rows['last']
+
+
+def store_path(filename):
+    return filename + '.store'
+
+
+def open_transect_store(filename):
+    """TransectStore of a converted transect file, None if it is missing or older than the file"""
+    directory = store_path(filename)
+    try:
+        with open(os.path.join(directory, 'meta.json')) as infile:
+            meta = json.load(infile)
+    except (OSError, ValueError):
+        return None
+    if meta['version'] != STORE_VERSION or meta['signature'] != file_signature(filename):
+        return None
+    index = np.load(os.path.join(directory, 'index.npy'))
+    # an empty file cannot be memory-mapped
+    mmap_mode = 'r' if index['length'].sum() else None
+    return TransectStore(index, np.load(os.path.join(directory, 'samples.npy'), mmap_mode=mmap_mode))
+
+
+def convert_transects(filename, block=BLOCK):
+    """Write the store of a transect file, reading block transects at a time"""
+    signature = file_signature(filename)
+    directory = store_path(filename)
+    tmp = '{}.tmp-{}'.format(directory, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+
+    # first pass: index (valid lengths and dates), second pass: the valid measures
+    index = np.concatenate([index_rows(transects) for _, transects in _blocks(filename, block)] or
+                           [np.zeros(0, dtype=INDEX_DTYPE)])
+    _set_offsets(index)
+    nmeasures = int(index['length'].sum())
+    if nmeasures:
+        samples = np.lib.format.open_memmap(os.path.join(tmp, 'samples.npy'), mode='w+', dtype=np.float64,
+                                            shape=(nmeasures, 5))
+        for start, transects in _blocks(filename, block):
+            for i, transect in enumerate(transects):
+                row = index[start + i]
+                samples[row['offset']:row['offset'] + row['length']] = transect[:row['length']]
+        samples.flush()
+        del samples
+    else:
+        np.save(os.path.join(tmp, 'samples.npy'), np.empty((0, 5)))
+    np.save(os.path.join(tmp, 'index.npy'), index)
+    with open(os.path.join(tmp, 'meta.json'), 'w') as outfile:
+        json.dump({'version': STORE_VERSION, 'signature': signature, 'transects': len(index)}, outfile)
+
+    shutil.rmtree(directory, ignore_errors=True)
+    os.rename(tmp, directory)
+    return len(index), nmeasures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert transect files to the indexed transect store')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--block', type=int, default=BLOCK, help='transects read at a time')
+    args = parser.parse_args()
+    for filename in args.files:
+        ntransects, nmeasures = convert_transects(filename, args.block)
+        print('{}: {} transects, {} measures -> {}'.format(filename, ntransects, nmeasures, store_path(filename)))
+
+
+if __name__ == '__main__':
+    main()